@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "python_test"))
+from check_repodata import install_package, link_file
+
+# usage: ./bench_link.py [scale]
+# from_dir の bin / lib 構成を scale 倍に複製したダミーパッケージを .prefix にリンクして比べる
+#   naive : ファイルごとに os.makedirs してから 1 つずつリンク (以前の install_package と同じ形)
+#   N     : install_package (ディレクトリは 1 回ずつ作成，リンクは N スレッド)
+
+from_pkg = os.path.join(os.path.dirname(os.path.abspath(__file__)), "from_dir")
+scale = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+work_dir = tempfile.mkdtemp()
+cache_dir = os.path.join(work_dir, ".cache")
+package_name = "dummy-1.0-h0000000_0"
+package_path = os.path.join(cache_dir, package_name)
+
+os.makedirs(os.path.join(package_path, "info"))
+open(os.path.join(package_path, "metadata.json"), mode="w").close()
+for i in range(scale):
+    for root, dirs, files in os.walk(from_pkg):
+        _destination_dir = os.path.join(package_path, os.path.relpath(root, from_pkg), f"sub{i // 500}")
+        os.makedirs(_destination_dir, exist_ok=True)
+        for f in files:
+            shutil.copy2(os.path.join(root, f), os.path.join(_destination_dir, f"{i}_{f}"))
+n_files = sum(len(files) for _, _, files in os.walk(package_path))
+print(f"{n_files} files")
+
+# install_package は info/paths.json を見るので，本物のパッケージと同じように書いておく
+paths = [{"_path": os.path.relpath(os.path.join(root, f), package_path), "path_type": "hardlink",
+          "size_in_bytes": os.path.getsize(os.path.join(root, f))}
+         for item in os.listdir(package_path) if item not in ("info", "metadata.json")
+         for root, dirs, files in os.walk(os.path.join(package_path, item)) for f in files]
+with open(os.path.join(package_path, "info", "paths.json"), mode="w") as f:
+    json.dump({"paths": paths, "paths_version": 1}, f)
+
+
+def naive_install(destination_dir):
+    for item in os.listdir(package_path):
+        if item in ("info", "metadata.json"):
+            continue
+        for root, dirs, files in os.walk(os.path.join(package_path, item)):
+            for f in files:
+                _destination_dir = root.replace(package_path, destination_dir, 1)
+                os.makedirs(_destination_dir, exist_ok=True)
+                link_file(os.path.join(root, f), os.path.join(_destination_dir, f))
+
+
+prefix = os.path.join(work_dir, ".prefix")
+start_time = time.time()
+naive_install(prefix)
+elapsed = time.time() - start_time
+print(f"naive      : {elapsed:.3f} s ({n_files / elapsed:.0f} files/s)")
+shutil.rmtree(prefix)
+
+for max_workers in (1, 4, 16):
+    start_time = time.time()
+    install_package(package_name, prefix, cache_dir, max_workers=max_workers)
+    elapsed = time.time() - start_time
+    print(f"workers={max_workers:<3d}: {elapsed:.3f} s ({n_files / elapsed:.0f} files/s)")
+    shutil.rmtree(prefix)
+
+shutil.rmtree(work_dir)
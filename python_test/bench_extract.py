@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import io
+import json
+import time
+import shutil
+import hashlib
+import tarfile
+import zipfile
+import tempfile
+import zstandard as zstd
+from concurrent.futures import ProcessPoolExecutor
+from check_repodata import extract_conda_package
+
+# usage: ./bench_extract.py [n_packages] [files_per_package]
+# ダミーの .conda を作り，展開のプロセス数を変えて時間を比べる
+
+
+def _tar_zst(entries: dict) -> bytes:
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w') as tar:
+        for path, data in entries.items():
+            ti = tarfile.TarInfo(path)
+            ti.size = len(data)
+            ti.mode = 0o755 if path.startswith("bin/") else 0o644
+            tar.addfile(ti, io.BytesIO(data))
+
+    return zstd.ZstdCompressor(level=10).compress(buf.getvalue())
+
+
+def make_conda_package(conda_path: str, files: dict):
+    """
+    files ({path: bytes}) を pkg-*.tar.zst に，index.json / paths.json を info-*.tar.zst に入れた .conda を作る
+    """
+    basename = os.path.basename(conda_path)[:-len(".conda")]
+    name = basename.rsplit("-", 2)[0]
+    paths = [{"_path": path, "path_type": "hardlink",
+              "sha256": hashlib.sha256(data).hexdigest(), "size_in_bytes": len(data)}
+             for path, data in files.items()]
+    info = {
+        "info/index.json": json.dumps({"name": name}).encode(),
+        "info/paths.json": json.dumps({"paths": paths, "paths_version": 1}).encode(),
+    }
+    with zipfile.ZipFile(conda_path, 'w', zipfile.ZIP_STORED) as zf:
+        zf.writestr("metadata.json", json.dumps({"conda_pkg_format_version": 2}))
+        zf.writestr(f"pkg-{basename}.tar.zst", _tar_zst(files))
+        zf.writestr(f"info-{basename}.tar.zst", _tar_zst(info))
+
+
+def dummy_files(seed: int, n_files: int) -> dict:
+    # 圧縮が効く程度に繰り返しのある中身にする
+    files = {}
+    for i in range(n_files):
+        line = f"package {seed} file {i} ".encode() + os.urandom(16).hex().encode() + b"\n"
+        files[f"lib/pkg{seed}/file{i}.txt"] = line * (200 + i % 300)
+    files[f"bin/pkg{seed}"] = b"#!/bin/sh\necho hello\n"
+
+    return files
+
+
+if __name__ == "__main__":
+    n_packages = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    files_per_package = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    work_dir = tempfile.mkdtemp()
+    conda_files = []
+    for i in range(n_packages):
+        conda_path = os.path.join(work_dir, f"pkg{i}-1.0-h0000000_0.conda")
+        make_conda_package(conda_path, dummy_files(i, files_per_package))
+        conda_files.append(conda_path)
+    total = sum(os.path.getsize(p) for p in conda_files)
+    print(f"{n_packages} packages x {files_per_package} files ({total / 1e6:.1f} MB compressed)")
+
+    workers = [1]
+    while workers[-1] * 2 <= os.cpu_count():
+        workers.append(workers[-1] * 2)
+    if workers[-1] != os.cpu_count():
+        workers.append(os.cpu_count())
+
+    base_time = None
+    for n_workers in workers:
+        output_dir = os.path.join(work_dir, "extracted")
+        start_time = time.time()
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(extract_conda_package, p, os.path.join(output_dir, os.path.basename(p)[:-6]))
+                       for p in conda_files]
+            for future in futures:
+                future.result()
+        elapsed = time.time() - start_time
+        base_time = base_time or elapsed
+        print(f"workers={n_workers:3d}: {elapsed:.2f} s (x{base_time / elapsed:.2f})")
+        shutil.rmtree(output_dir)
+
+    shutil.rmtree(work_dir)
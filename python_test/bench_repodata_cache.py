@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import time
+import json
+import tempfile
+import tracemalloc
+from repodata_cache import build_name_index, load_name_index, open_raw_index
+from check_repodata_v3 import PackageMetaInfo
+
+# usage: ./bench_repodata_cache.py [repodata_linux-64.json]
+# 引数が無ければ conda-forge 程度の件数のダミー repodata を作って計測する
+
+def make_dummy_repodata(json_path: str, n_records=500_000):
+    packages = {}
+    for i in range(n_records):
+        name = f"pkg{i % 30000}"
+        version = f"{i % 7}.{i % 13}.{i % 5}"
+        build = f"h{i:08x}_{i % 3}"
+        packages[f"{name}-{version}-{build}.conda"] = {
+            "build": build,
+            "build_number": i % 3,
+            "depends": ["python >=3.10,<3.11.0a0", "libgcc >=13"],
+            "license": "MIT",
+            "md5": f"{i:032x}",
+            "name": name,
+            "sha256": f"{i:064x}",
+            "size": i,
+            "subdir": "linux-64",
+            "timestamp": 1700000000000 + i,
+            "version": version,
+        }
+    with open(json_path, mode="w") as f:
+        json.dump({"info": {"subdir": "linux-64"}, "packages": {}, "packages.conda": packages}, f, indent=2)
+
+
+if __name__ == "__main__":
+    tmp_dir = tempfile.mkdtemp()
+    if len(sys.argv) > 1:
+        json_path = sys.argv[1]
+    else:
+        json_path = os.path.join(tmp_dir, "repodata_linux-64.json")
+        make_dummy_repodata(json_path)
+    cache_path = os.path.join(tmp_dir, "repodata_linux-64.cache")
+
+    print(f"source: {json_path} ({os.path.getsize(json_path) / 1e6:.1f} MB)")
+
+    # cold: 毎回 json.load して索引を作る（キャッシュ導入前と同じ）
+    start_time = time.time()
+    with open(json_path, mode="r") as f:
+        index = build_name_index(json.load(f))
+    print(f"cold (json.load + index):  {time.time() - start_time:.3f} s")
+
+    # cold (lazy): json のレコードの位置だけ拾って 1 件引くまで
+    name = next(iter(index))
+    start_time = time.time()
+    raw_index = open_raw_index(json_path)
+    raw_records = raw_index.get(name)
+    print(f"cold (offsets + 1 lookup): {time.time() - start_time:.3f} s")
+    assert [r[:-1] for r in raw_records] == [r[:-1] for r in index[name]]
+    del raw_index
+
+    # 初回: json からキャッシュを作る
+    start_time = time.time()
+    load_name_index(json_path, cache_path, background=False)
+    print(f"build cache:               {time.time() - start_time:.3f} s "
+          f"({os.path.getsize(cache_path) / 1e6:.1f} MB)")
+
+    # warm: キャッシュを開いて 1 件引くまで
+    start_time = time.time()
+    warm_index = load_name_index(json_path, cache_path)
+    records = warm_index.get(name)
+    print(f"warm (cache + 1 lookup):   {time.time() - start_time:.3f} s")
+
+    # 全名前を decode したときの合計
+    start_time = time.time()
+    for n in warm_index:
+        warm_index.get(n)
+    print(f"warm (decode all names):   {time.time() - start_time:.3f} s")
+
+    assert records == index[name]
+
+    # メモリ: json の dict のまま持つ場合と PackageMetaInfo (__slots__) で持つ場合
+    del index
+    tracemalloc.start()
+    with open(json_path, mode="r") as f:
+        dict_records = list(json.load(f)["packages.conda"].values())
+    dict_size, _ = tracemalloc.get_traced_memory()
+    del dict_records
+    tracemalloc.stop()
+
+    tracemalloc.start()
+    slot_records = [PackageMetaInfo.from_row(row) for n in warm_index for row in warm_index.get(n)]
+    slot_size, _ = tracemalloc.get_traced_memory()
+    del slot_records
+    tracemalloc.stop()
+    tracemalloc.start()
+    raw_index = open_raw_index(json_path)
+    raw_index.get(name)
+    _, raw_peak = tracemalloc.get_traced_memory()
+    del raw_index
+    tracemalloc.stop()
+    print(f"memory dict records:       {dict_size / 1e6:.1f} MB")
+    print(f"memory offsets (peak):     {raw_peak / 1e6:.1f} MB")
+    print(f"memory PackageMetaInfo:    {slot_size / 1e6:.1f} MB ({dict_size / slot_size:.1f}x smaller)")
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import sys
+import json
+import time
+import tempfile
+import threading
+import contextlib
+from functools import partial
+from http.server import ThreadingHTTPServer
+from check_repodata_fetch import ChannelHandler
+from check_repodata_v3 import RepoData, resolve
+
+# usage: ./bench_resolve.py [depth] [width] [n_versions]
+# depth 段 x width 個のダミーパッケージで，各パッケージが次の段の全パッケージに依存する
+# (tensorflow のような深くて共有の多い依存ツリーの代わり) チャンネルをローカルに立てて resolve を測る
+
+
+def make_packages(depth: int, width: int, n_versions: int) -> dict:
+    packages = {}
+    for level in range(depth):
+        for i in range(width):
+            name = f"pkg-{level}-{i}"
+            depends = [f"pkg-{level + 1}-{j} >=1.0,<{n_versions + 1}" for j in range(width)] if level + 1 < depth else []
+            for v in range(1, n_versions + 1):
+                packages[f"{name}-{v}.0-h0000000_0.conda"] = {
+                    "name": name, "version": f"{v}.0", "build": "h0000000_0", "build_number": 0,
+                    "depends": depends + ["__glibc >=2.17"], "subdir": "linux-64",
+                }
+
+    return packages
+
+
+if __name__ == "__main__":
+    depth = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+    width = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    n_versions = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+
+    channel_dir = tempfile.mkdtemp()
+    work_dir = tempfile.mkdtemp()
+    for subdir, packages in (("linux-64", make_packages(depth, width, n_versions)), ("noarch", {})):
+        os.makedirs(os.path.join(channel_dir, subdir))
+        with open(os.path.join(channel_dir, subdir, "repodata.json"), mode="w") as f:
+            json.dump({"info": {"subdir": subdir}, "packages": {}, "packages.conda": packages}, f)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), partial(ChannelHandler, directory=channel_dir))
+    server.requests_log = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    repodata = RepoData(path=work_dir, channels=[f"http://127.0.0.1:{server.server_port}/"])
+    print(f"{depth} levels x {width} packages x {n_versions} versions")
+
+    specs = [f"pkg-0-{i}" for i in range(width)]
+    for _ in range(2):
+        start_time = time.time()
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = resolve(repodata, specs)
+        elapsed = time.time() - start_time
+        assert len(result) == depth * width
+        assert all(p.version == f"{n_versions}.0" for p in result)
+        print(f"resolve: {elapsed:.3f} s ({len(result)} packages)")
+
+    server.shutdown()
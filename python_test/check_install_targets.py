@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import json
+import hashlib
+import tarfile
+import zipfile
+import tempfile
+import threading
+import requests
+import zstandard as zstd
+from functools import partial
+from http.server import ThreadingHTTPServer
+from check_repodata_fetch import ChannelHandler
+from check_repodata_v3 import PackageMetaInfo, install_targets
+from check_repodata import load_conda_meta, verify_prefix
+
+# ローカルの HTTP サーバに .conda を置いて install_targets を確認する
+# 入れ替えのダウンロードや hash の確認で失敗しても，prefix (ファイルと conda-meta) は元のまま
+# 壊れたファイルは conda-meta の paths_data で見つけて入れ直せる
+
+
+def _tar_zst(files: dict) -> bytes:
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        for path, data in files.items():
+            info = tarfile.TarInfo(path)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return zstd.ZstdCompressor().compress(buffer.getvalue())
+
+
+def write_conda_package(channel_dir: str, channel: str, name: str, version: str, files: dict) -> PackageMetaInfo:
+    """
+    files ({path: bytes}) を入れた .conda を channel_dir/linux-64 に書き，その PackageMetaInfo を返す
+    """
+    stem = f"{name}-{version}-h0_0"
+    paths = [{"_path": path, "path_type": "hardlink", "sha256": hashlib.sha256(data).hexdigest(),
+              "size_in_bytes": len(data)} for path, data in files.items()]
+    info_files = {"info/paths.json": json.dumps({"paths": paths, "paths_version": 1}).encode()}
+
+    os.makedirs(os.path.join(channel_dir, "linux-64"), exist_ok=True)
+    package_path = os.path.join(channel_dir, "linux-64", stem + ".conda")
+    with zipfile.ZipFile(package_path, mode="w") as zf:
+        zf.writestr("metadata.json", json.dumps({"conda_pkg_format_version": 2}))
+        zf.writestr(f"info-{stem}.tar.zst", _tar_zst(info_files))
+        zf.writestr(f"pkg-{stem}.tar.zst", _tar_zst(files))
+    with open(package_path, mode="rb") as f:
+        data = f.read()
+
+    return PackageMetaInfo.from_row((stem + ".conda", name, version, "h0_0", 0, (), "linux-64", None, None,
+                                     hashlib.sha256(data).hexdigest(), len(data), None), channel)
+
+
+def prefix_state(prefix: str) -> dict:
+    state = {}
+    for root, dirs, files in os.walk(prefix):
+        for f in files:
+            path = os.path.join(root, f)
+            with open(path, mode="rb") as fp:
+                state[os.path.relpath(path, prefix)] = fp.read()
+    return state
+
+
+if __name__ == "__main__":
+    channel_dir = tempfile.mkdtemp()
+    work_dir = tempfile.mkdtemp()
+    prefix = os.path.join(work_dir, ".prefix")
+    cd = os.path.join(work_dir, ".cache")
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), partial(ChannelHandler, directory=channel_dir))
+    server.requests_log = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    channel = f"http://127.0.0.1:{server.server_port}/"
+
+    # 1. 初回のインストール
+    zlib_1 = write_conda_package(channel_dir, channel, "zlib", "1.0", {"lib/libz.so": b"zlib 1.0"})
+    install_targets([zlib_1], prefix, cd)
+    assert load_conda_meta(prefix)["zlib"]["version"] == "1.0"
+    before = prefix_state(prefix)
+    assert before["lib/libz.so"] == b"zlib 1.0"
+
+    # 2. 入れ替えるパッケージがチャンネルに無い (404): 古いものを消さずに失敗する
+    zlib_2 = write_conda_package(channel_dir, channel, "zlib", "2.0", {"lib/libz.so": b"zlib 2.0", "lib/libz.a": b"a"})
+    os.rename(os.path.join(channel_dir, "linux-64", zlib_2.package_name),
+              os.path.join(channel_dir, "linux-64", zlib_2.package_name + ".hidden"))
+    try:
+        install_targets([zlib_2], prefix, cd)
+        assert False
+    except requests.HTTPError as e:
+        print("download failed:", e)
+    assert prefix_state(prefix) == before
+
+    # 3. sha256 が合わない: 同じく prefix はそのまま
+    os.rename(os.path.join(channel_dir, "linux-64", zlib_2.package_name + ".hidden"),
+              os.path.join(channel_dir, "linux-64", zlib_2.package_name))
+    broken = PackageMetaInfo.from_row((zlib_2.package_name, "zlib", "2.0", "h0_0", 0, (), "linux-64", None, None,
+                                       "0" * 64, zlib_2.size, None), channel)
+    try:
+        install_targets([broken], prefix, cd)
+        assert False
+    except ValueError as e:
+        print("hash mismatch:", e)
+    assert prefix_state(prefix) == before
+
+    # 4. 正しいものなら入れ替わる
+    install_targets([zlib_2], prefix, cd)
+    after = prefix_state(prefix)
+    assert after["lib/libz.so"] == b"zlib 2.0" and after["lib/libz.a"] == b"a"
+    assert load_conda_meta(prefix)["zlib"]["version"] == "2.0"
+    assert not any(path.endswith("zlib-1.0-h0_0.json") for path in after)
+
+    # 5. 書き換えられた・消されたファイルは verify_prefix で見つかり，verify=True で入れ直される
+    os.remove(os.path.join(prefix, "lib", "libz.so"))  # キャッシュとの hardlink を切ってから書く
+    with open(os.path.join(prefix, "lib", "libz.so"), mode="wb") as f:
+        f.write(b"zlib 2.x")
+    os.remove(os.path.join(prefix, "lib", "libz.a"))
+    assert {name: sorted(paths) for name, paths in verify_prefix(prefix).items()} == {"zlib": ["lib/libz.a", "lib/libz.so"]}
+    assert install_targets([zlib_2], prefix, cd)[0] == []
+    assert verify_prefix(prefix) != {}
+    to_add, to_remove, unchanged = install_targets([zlib_2], prefix, cd, verify=True)
+    assert [p.name for p in to_add] == ["zlib"] and to_remove == [] and unchanged == []
+    assert verify_prefix(prefix) == {}
+    assert prefix_state(prefix) == after
+
+    server.shutdown()
+    print("ok")
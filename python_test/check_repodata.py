@@ -4,20 +4,36 @@ import sys
 import os
 import time
 import json
+import hashlib
 import requests
 from IPython import embed
 from urllib.parse import urljoin
 import os
 import shutil
 import tarfile
+import zipfile
 import zstandard as zstd
 import re
+import multiprocessing
 from packaging.version import Version
 from pprint import pprint
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from repodata_fetch import make_session
 
 base_conda_forge_donwload_url = "https://conda.anaconda.org/conda-forge/"
 base_anaconda_donwload_url = "https://repo.anaconda.com/pkgs/main/"
 
+DOWNLOAD_CHUNK_SIZE = 1 << 16
+MAX_DOWNLOAD_WORKERS = 8
+MAX_LINK_WORKERS = 16
+FICLONE = 0x40049409  # linux/fs.h
+# 展開のプロセスは fork で作らない (ダウンロードのスレッドや Session のロックを持ったまま複製されてデッドロックしうる)
+EXTRACT_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
 # download url sample: both 2 packages url have same hash
 # "https://anaconda.org/anaconda/llama.cpp/0.0.6872/download/linux-64/llama.cpp-0.0.6872-cuda124_h3e60e59_100.tar.bz2"
 # https://repo.anaconda.com/pkgs/main/linux-64/llama.cpp-0.0.6872-cuda124_h3e60e59_100.tar.bz2
@@ -77,67 +93,383 @@ def search_candidate(tp: str, repodata) -> list:
 
 # INSTALL TO .PREFIX/
 # extract package
-# 1. unzip numpy-1.23.5-py310h53a5b5f_0.conda
-#   get info-numpy-1.23.5-py310h53a5b5f_0.tar.zst and pkg-numpy-1.23.5-py310h53a5b5f_0.tar.zst
-# 2. unzstd tar.zst
-# 3. tar -xvf .tar
+# numpy-1.23.5-py310h53a5b5f_0.conda (zip) の中の
+#   info-numpy-1.23.5-py310h53a5b5f_0.tar.zst と pkg-numpy-1.23.5-py310h53a5b5f_0.tar.zst を
+# zip のメンバー -> zstd 展開 -> tar のストリームとして一度に読み，output_dir に直接書き出す
 def extract_conda_package(conda_file: str, output_dir: str):
     """
     .conda パッケージを展開して output_dir に配置する
+    途中の .tar.zst / .tar はディスクに書かない（1 パスで展開する）
     """
 
-    os.makedirs(output_dir, exist_ok=True)
+    # 展開しきったものだけがキャッシュとして見えるように，別名で展開してから rename する
+    extracting_dir = output_dir + ".extracting"
+    if os.path.exists(extracting_dir):
+        shutil.rmtree(extracting_dir)
+    os.makedirs(extracting_dir)
 
-    # 1. .conda は zip として扱える
-    import zipfile
+    # .conda は zip として扱える
     with zipfile.ZipFile(conda_file, 'r') as zip_ref:
-        zip_ref.extractall(output_dir)
-    
-    # 2. 展開された .tar.zst ファイルをさらに解凍
-    for filename in os.listdir(output_dir):
-        if filename.endswith(".tar.zst"):
-            tar_zst_path = os.path.join(output_dir, filename)
-            tar_path = tar_zst_path[:-4]  # .zst を削除して tar ファイル名に
-            
-            # zstd 解凍
-            with open(tar_zst_path, 'rb') as f_in, open(tar_path, 'wb') as f_out:
-                dctx = zstd.ZstdDecompressor()
-                dctx.copy_stream(f_in, f_out)
-            
-            # 3. tar を展開
-            with tarfile.open(tar_path, 'r') as tar:
-                tar.extractall(output_dir)
-            
-            # 不要になった .tar.zst と .tar を削除（任意）
-            os.remove(tar_zst_path)
-            os.remove(tar_path)
-
-def download_package(package: str, cd = ".cache"):
-    # download package
-    download_url = urljoin(base_conda_forge_donwload_url, os.path.join("linux-64", package['filename.conda']))
-    pkg_data = requests.get(download_url).content
+        for member in zip_ref.infolist():
+            if not member.filename.endswith(".tar.zst"):
+                # metadata.json などはそのまま
+                zip_ref.extract(member, extracting_dir)
+                continue
+
+            # zip のメンバーを zstd のストリームとして読み，tar もストリームモード ("r|") で展開
+            with zip_ref.open(member) as zst_stream, \
+                    zstd.ZstdDecompressor().stream_reader(zst_stream) as tar_stream, \
+                    tarfile.open(fileobj=tar_stream, mode='r|') as tar:
+                tar.extractall(extracting_dir)
+
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    os.rename(extracting_dir, output_dir)
+
+def package_url(package: dict) -> str:
+    # url が無ければ channel / subdir から組み立てる（どちらも無ければ conda-forge の linux-64）
+    if package.get('url'):
+        return package['url']
+    channel = package.get('channel') or base_conda_forge_donwload_url
+    return urljoin(channel, os.path.join(package.get('subdir') or "linux-64", package['filename.conda']))
+
+def _package_hasher(package: dict):
+    # repodata の sha256 を優先し，無ければ md5 で検証する
+    if package.get('sha256'):
+        return hashlib.sha256(), package['sha256']
+    if package.get('md5'):
+        return hashlib.md5(), package['md5']
+    return None, None
+
+def verify_cached_package(package: dict, package_path: str) -> bool:
+    """
+    .cache に既にあるアーカイブが repodata の size / hash と一致するか
+    """
+    hasher, expected = _package_hasher(package)
+    if hasher is None or not os.path.exists(package_path):
+        return False
+    if package.get('size') is not None and os.path.getsize(package_path) != package['size']:
+        return False
+
+    with open(package_path, mode='rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            hasher.update(chunk)
+
+    return hasher.hexdigest() == expected
+
+def download_package(package: dict, cd = ".cache", session=None) -> int:
+    """
+    パッケージをチャンクごとに .cache へ書き込みながらダウンロードし，書いたバイト数を返す
+    アーカイブ全体をメモリに載せない．書き終わるまでは .part に書く
+    書いたチャンクと同じものでハッシュを計算し，size / sha256 (md5) が合わなければ捨てて ValueError
+    既に .cache にハッシュの一致するアーカイブがあればダウンロードしない（0 を返す）
+    """
+    session = session or requests
     # create .cache dir
     os.makedirs(cd, exist_ok=True)
-    with open(os.path.join(cd, package['filename.conda']), mode='wb') as f: # wb でバイト型を書き込める
-        f.write(pkg_data)    
+    package_path = os.path.join(cd, package['filename.conda'])
+    part_path = package_path + ".part"
+
+    if verify_cached_package(package, package_path):
+        return 0
+
+    hasher, expected = _package_hasher(package)
+    size = 0
+    try:
+        with session.get(package_url(package), stream=True, timeout=60) as response:
+            response.raise_for_status()
+            with open(part_path, mode='wb') as f: # wb でバイト型を書き込める
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+                    size += len(chunk)
+                    if hasher:
+                        hasher.update(chunk)
+
+        if package.get('size') is not None and size != package['size']:
+            raise ValueError(f"size mismatch: {package['filename.conda']} "
+                             f"(expected {package['size']}, got {size})")
+        if hasher and hasher.hexdigest() != expected:
+            raise ValueError(f"{hasher.name} mismatch: {package['filename.conda']} "
+                             f"(expected {expected}, got {hasher.hexdigest()})")
+    except BaseException:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    os.replace(part_path, package_path)
+
+    return size
+
+def download_packages(packages: list, cd = ".cache", max_workers=MAX_DOWNLOAD_WORKERS,
+                      extractor=None) -> list:
+    """
+    解決済みのパッケージをまとめて並行ダウンロードする（同時接続数は max_workers まで）
+    接続は 1 つの Session のプールを使い回し，最後に全体のスループットを表示する
+    extractor (Executor) を渡すと，ダウンロードが終わったものから順に展開を投げる
+    """
+    start_time = time.time()
+    session = make_session(max_workers)
+
+    sizes = []
+    extract_futures = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        download_futures = {executor.submit(download_package, p, cd, session): p for p in packages}
+        for future in as_completed(download_futures):
+            sizes.append(future.result())
+            if extractor is not None:
+                p = download_futures[future]
+                extract_futures.append(extractor.submit(
+                    extract_conda_package,
+                    os.path.join(cd, p['filename.conda']),
+                    os.path.join(cd, p['filename'])
+                ))
+
+    elapsed = time.time() - start_time
+    total = sum(sizes)
+    cached = sizes.count(0)
+    print(f"downloaded {len(packages) - cached} packages ({cached} already in cache), "
+          f"{total / 1e6:.1f} MB in {elapsed:.2f} s ({total / 1e6 / max(elapsed, 1e-9):.1f} MB/s)")
+
+    # 展開のエラーもここで拾う
+    for future in extract_futures:
+        future.result()
+
+    return [os.path.join(cd, p['filename.conda']) for p in packages]
+
+def download_and_extract_packages(packages: list, cd = ".cache", max_extract_workers=None) -> list:
+    """
+    ダウンロードと展開をパイプラインにする．zstd 展開と tar 展開は CPU を使うのでプロセスプールで並列に行う
+    プロセスプールは forkserver (無ければ spawn) で作る
+    展開先は cd/<filename>．既に展開済みのキャッシュがあるパッケージはダウンロードも展開もしない
+    """
+    start_time = time.time()
+    missing = [p for p in packages if not os.path.isdir(os.path.join(cd, p['filename']))]
+    if missing:
+        with ProcessPoolExecutor(max_workers=max_extract_workers,
+                                 mp_context=multiprocessing.get_context(EXTRACT_START_METHOD)) as extractor:
+            download_packages(missing, cd, extractor=extractor)
+    print(f"downloaded and extracted {len(packages)} packages in {time.time() - start_time:.2f} s")
+
+    return [os.path.join(cd, p['filename']) for p in packages]
+
+def _reflink(src: str, dst: str):
+    # Linux の FICLONE ioctl (btrfs / xfs などの copy-on-write コピー)
+    if fcntl is None:
+        raise OSError("reflink is not supported on this platform")
+    with open(src, mode='rb') as f_src, open(dst, mode='wb') as f_dst:
+        fcntl.ioctl(f_dst.fileno(), FICLONE, f_src.fileno())
+    shutil.copymode(src, dst)
+
+def _copy_file(src: str, dst: str, size=None):
+    """
+    size が分かっていれば先にその大きさだけ領域を確保してからコピーする
+    """
+    with open(src, mode='rb') as f_src, open(dst, mode='wb') as f_dst:
+        if size and hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(f_dst.fileno(), 0, size)
+            except OSError:
+                pass
+        shutil.copyfileobj(f_src, f_dst, DOWNLOAD_CHUNK_SIZE)
+    shutil.copystat(src, dst)
 
-def install_package(package_name: str):
-    package_path = os.path.join(".cache", package_name)
+def link_file(src: str, dst: str, size=None, no_link=False) -> str:
+    """
+    キャッシュのファイル src を dst に置く．hardlink -> reflink -> copy の順に試し，使った方法を返す
+    キャッシュ側は壊さないので，同じパッケージを別の環境にもすぐ入れられる
+    no_link のファイルは必ずコピーする
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+
+    if os.path.islink(src):
+        os.symlink(os.readlink(src), dst)
+        return "symlink"
+
+    if not no_link:
+        try:
+            os.link(src, dst)
+            return "hardlink"
+        except OSError:
+            # 別デバイス (EXDEV) やハードリンク非対応のファイルシステム
+            pass
+
+        try:
+            _reflink(src, dst)
+            return "reflink"
+        except OSError:
+            if os.path.exists(dst):
+                os.remove(dst)
+
+    _copy_file(src, dst, size)
+    return "copy"
+
+def read_package_paths(package_path: str) -> list:
+    """
+    info/paths.json の paths（_path / path_type / sha256 / size_in_bytes）を返す
+    paths.json が無い古いパッケージだけディレクトリを walk して同じ形にする
+    """
+    paths_json = os.path.join(package_path, "info", "paths.json")
+    if os.path.exists(paths_json):
+        with open(paths_json, mode="r") as f:
+            return json.load(f)["paths"]
+
+    paths = []
+    for root, dirs, files in os.walk(package_path):
+        rel_root = os.path.relpath(root, package_path)
+        if rel_root == ".":
+            dirs.remove("info")
+            files.remove("metadata.json")
+        # ディレクトリへのシンボリックリンクも os.walk では dirs に入るのでリンクとして置く
+        for f in files + [d for d in dirs if os.path.islink(os.path.join(root, d))]:
+            _path = os.path.normpath(os.path.join(rel_root, f))
+            paths.append({"_path": _path,
+                          "path_type": "softlink" if os.path.islink(os.path.join(root, f)) else "hardlink"})
+
+    return paths
+
+def verify_package_files(destination_dir: str, paths: list) -> list:
+    """
+    install_package が返した paths と destination_dir の中身を比べ，size / sha256 が合わないパスを返す
+    """
+    broken = []
+    for p in paths:
+        if p.get("path_type") != "hardlink":
+            continue
+        path = os.path.join(destination_dir, p["_path"])
+        if not os.path.exists(path):
+            broken.append(p["_path"])
+            continue
+        if p.get("size_in_bytes") is not None and os.path.getsize(path) != p["size_in_bytes"]:
+            broken.append(p["_path"])
+            continue
+        if p.get("sha256"):
+            hasher = hashlib.sha256()
+            with open(path, mode='rb') as f:
+                for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+                    hasher.update(chunk)
+            if hasher.hexdigest() != p["sha256"]:
+                broken.append(p["_path"])
+
+    return broken
+
+def install_package(package_name: str, destination_dir = ".prefix", cd = ".cache",
+                    max_workers=MAX_LINK_WORKERS) -> list:
+    """
+    展開済みのキャッシュ cd/<package_name> から destination_dir にファイルをリンクする
+    何を置くかは info/paths.json で決める（ディレクトリを walk しない）
+    置き先のディレクトリを先に全部求めて 1 回ずつ作り，ファイルのリンクはスレッドプールで行う
+    後で検証やアンインストールに使えるように paths（sha256 / size_in_bytes 付き）を返す
+    """
+    start_time = time.time()
+    package_path = os.path.join(cd, package_name)
+    paths = read_package_paths(package_path)
+
+    files = [p for p in paths if p.get("path_type") != "directory"]
+
+    # 置き先のディレクトリはファイルごとではなく 1 回ずつだけ作る（directory 型の空ディレクトリも含む）
+    directories = {os.path.dirname(os.path.join(destination_dir, p["_path"])) for p in files}
+    directories |= {os.path.join(destination_dir, p["_path"]) for p in paths if p.get("path_type") == "directory"}
+    for _destination_dir in sorted(directories):
+        os.makedirs(_destination_dir, exist_ok=True)
+
+    # ファイルごとに future を作ると重いので，スレッド数ぶんのまとまりに分けて渡す
+    def _link_files(_files):
+        for p in _files:
+            link_file(os.path.join(package_path, p["_path"]), os.path.join(destination_dir, p["_path"]),
+                      p.get("size_in_bytes"), p.get("no_link", False))
+
+    if max_workers <= 1 or len(files) < max_workers * 8:
+        _link_files(files)
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(_link_files, [files[i::max_workers] for i in range(max_workers)]))
+
+    elapsed = time.time() - start_time
+    print(f"linked {len(files)} files of {package_name} in {elapsed:.3f} s "
+          f"({len(files) / max(elapsed, 1e-9):.0f} files/s)")
+
+    return paths
+
+def _conda_meta_filename(record: dict) -> str:
+    return f"{record['name']}-{record['version']}-{record['build']}.json"
+
+def load_conda_meta(prefix = ".prefix") -> dict:
+    """
+    prefix/conda-meta/*.json（インストール済みパッケージの記録）を読み，name -> record を返す
+    """
+    meta_dir = os.path.join(prefix, "conda-meta")
+    if not os.path.isdir(meta_dir):
+        return {}
+
+    records = {}
+    for filename in os.listdir(meta_dir):
+        if not filename.endswith(".json"):
+            continue
+        with open(os.path.join(meta_dir, filename), mode="r") as f:
+            record = json.load(f)
+        records[record["name"]] = record
+
+    return records
+
+def write_conda_meta(package: dict, paths: list, prefix = ".prefix") -> str:
+    """
+    インストールしたパッケージの記録を prefix/conda-meta/<name>-<version>-<build>.json に書く
+    install_package が返した paths もそのまま残し，検証とアンインストールに使う
+    """
+    record = {k: v for k, v in package.items() if k not in ("filename", "filename.conda")}
+    record["fn"] = package["filename.conda"]
+    record["files"] = [p["_path"] for p in paths]
+    record["paths_data"] = {"paths": paths, "paths_version": 1}
 
-    file_dir_list = os.listdir(package_path)
-    file_dir_list.remove("info")
-    file_dir_list.remove("metadata.json")
+    meta_dir = os.path.join(prefix, "conda-meta")
+    os.makedirs(meta_dir, exist_ok=True)
+    meta_path = os.path.join(meta_dir, _conda_meta_filename(record))
+    with open(meta_path + ".tmp", mode="w") as f:
+        json.dump(record, f, indent=2)
+    os.replace(meta_path + ".tmp", meta_path)
 
-    destination_dir = ".prefix"
+    return meta_path
 
-    for directory in [os.path.join(package_path, d) for d in file_dir_list]:
-        for root, dirs, files in os.walk(directory):
-            for f in files:
-                _from = os.path.join(root, f)
-                _destination_dir = root.replace(package_path, destination_dir)
-                os.makedirs(_destination_dir, exist_ok=True)
-                _destination = os.path.join(_destination_dir, f)
-                shutil.move(_from, _destination)
+def remove_package(record: dict, prefix = ".prefix"):
+    """
+    conda-meta の record にある files だけを prefix から消す（prefix を walk しない）
+    空になったディレクトリは深い方から消し，最後に record 自体を消す
+    """
+    directories = set()
+    for _path in record.get("files", []):
+        path = os.path.join(prefix, _path)
+        if os.path.lexists(path):
+            os.remove(path)
+        parent = os.path.dirname(_path)
+        while parent and parent not in directories:
+            directories.add(parent)
+            parent = os.path.dirname(parent)
+
+    for directory in sorted(directories, key=lambda d: d.count("/"), reverse=True):
+        try:
+            os.rmdir(os.path.join(prefix, directory))
+        except OSError:
+            # 他のパッケージのファイルが残っている
+            pass
+
+    meta_path = os.path.join(prefix, "conda-meta", _conda_meta_filename(record))
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+
+def verify_prefix(prefix = ".prefix", names=None) -> dict:
+    """
+    conda-meta に残した paths_data で prefix のファイルを確かめる (names を渡せばその名前だけ)
+    無い・size / sha256 が合わないファイルのあるパッケージの name -> [_path, ...] を返す
+    """
+    broken = {}
+    for name, record in load_conda_meta(prefix).items():
+        if names is not None and name not in names:
+            continue
+        paths = verify_package_files(prefix, record.get("paths_data", {}).get("paths", []))
+        if paths:
+            broken[name] = paths
+
+    return broken
 
 # def find_dependencies(dependencies):
 #     virtual_package = ["__cuda", "__osx", "__glibc", "__linux", "__unix", "__win", "__conda"]
@@ -294,14 +626,14 @@ if __name__ == "__main__":
         have_to_check_dep += pi_dep
         have_to_check_dep.pop(0)
 
+    # repodata の sha256 / md5 / size をダウンロード時の検証に使う
+    for p in all_install_package_list:
+        p_info = repodata["packages.conda"][p['filename.conda']]
+        p.update(sha256=p_info.get('sha256'), md5=p_info.get('md5'), size=p_info.get('size'))
+
     # package install
+    download_and_extract_packages(all_install_package_list[::-1])
     for p in all_install_package_list[::-1]:
-        download_package(p)
-        cache_dir = ".cache"
-        extract_conda_package(
-            os.path.join(cache_dir, p['filename.conda']),
-            os.path.join(cache_dir, p['filename'].replace(".conda", ""))
-        )
         install_package(p['filename'])
 
     print(time.time() - start_time)
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import marshal
+import tempfile
+from repodata_cache import RawNameIndex, build_name_index, open_raw_index
+
+# scan_record_offsets が拾うレコードの範囲が json.load と同じになるか確認する
+# 範囲を正しく拾えない形 (入れ子の object など) のときは json.load にフォールバックする
+
+
+def rows(index, name):
+    # extra は marshal の bytes なので中身で比べる
+    return [row[:-1] + (marshal.loads(row[-1]) if row[-1] else None,) for row in index.get(name)]
+
+
+def check(packages: dict, raw: bool):
+    repodata = {"info": {"subdir": "linux-64"}, "packages": {}, "packages.conda": packages}
+    json_path = os.path.join(tempfile.mkdtemp(), "repodata_linux-64.json")
+    for indent in (None, 2):
+        with open(json_path, mode="w") as f:
+            json.dump(repodata, f, indent=indent)
+        index = open_raw_index(json_path)
+        expected = build_name_index(repodata)
+        assert isinstance(index, RawNameIndex) == raw, type(index)
+        assert set(index) == set(expected)
+        assert all(rows(index, name) == rows(expected, name) for name in expected)
+
+
+if __name__ == "__main__":
+    packages = {
+        "a-1-0.conda": {"name": "a", "version": "1", "build": "0", "depends": ["x }"]},
+        "b-1-0.conda": {"license": "name", "name": "b", "version": "1"},
+    }
+
+    # 1. 文字列の中の '}' や，値が "name" のもの
+    check(packages, raw=True)
+
+    # 2. '{' が文字列の中にあるだけ・名前にエスケープがあるものは範囲のまま読める
+    check(dict(packages, **{"c-1-0.conda": {"name": "c", "version": "1", "summary": "{ braces }"}}), raw=True)
+    check(dict(packages, **{"c-1-0.conda": {"name": "c\"q", "version": "1"}}), raw=True)
+
+    # 3. 入れ子の object があれば範囲は使わずに json.load する
+    check(dict(packages, **{"c-1-0.conda": {"name": "c", "version": "1", "extra": {"k": {"z": 1}}}}), raw=False)
+    check(dict(packages, **{"c-1-0.conda": {"extra": {"name": "z"}, "name": "c", "version": "1"}}), raw=False)
+
+    print("ok")
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+import requests
+import zstandard as zstd
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from repodata_fetch import fetch_repodata, load_fetch_state, channel_name
+from check_repodata_v3 import RepoData
+
+# ローカルの HTTP サーバを conda チャンネルの代わりに立てて fetch_repodata を確認する
+
+
+class ChannelHandler(SimpleHTTPRequestHandler):
+    """
+    SimpleHTTPRequestHandler に ETag / If-None-Match を足したもの
+    (Last-Modified / If-Modified-Since は元々対応している)
+    server.failing ({path: status}) にある path はそのステータスで失敗させる
+    """
+    def send_head(self):
+        status = getattr(self.server, "failing", {}).get(self.path)
+        if status:
+            self.send_error(status)
+            return None
+        path = self.translate_path(self.path)
+        if os.path.isfile(path):
+            with open(path, mode="rb") as f:
+                etag = '"' + hashlib.sha256(f.read()).hexdigest()[:16] + '"'
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return None
+            self._etag = etag
+        return super().send_head()
+
+    def end_headers(self):
+        etag = getattr(self, "_etag", None)
+        if etag:
+            self.send_header("ETag", etag)
+            self._etag = None
+        super().end_headers()
+
+    def log_message(self, format, *args):
+        self.server.requests_log.append(self.requestline)
+
+
+class SlowChannelHandler(ChannelHandler):
+    """
+    返す前に少し待つ ChannelHandler．同時に処理していたリクエスト数の最大を server.max_in_flight に残す
+    """
+    def send_head(self):
+        with self.server.lock:
+            self.server.in_flight += 1
+            self.server.max_in_flight = max(self.server.max_in_flight, self.server.in_flight)
+        try:
+            time.sleep(0.2)
+            return super().send_head()
+        finally:
+            with self.server.lock:
+                self.server.in_flight -= 1
+
+
+def write_channel(channel_dir: str, packages: dict):
+    for subdir, subdir_packages in (("linux-64", packages), ("noarch", {})):
+        os.makedirs(os.path.join(channel_dir, subdir), exist_ok=True)
+        with open(os.path.join(channel_dir, subdir, "repodata.json"), mode="w") as f:
+            json.dump({"info": {"subdir": subdir}, "packages": {}, "packages.conda": subdir_packages}, f)
+
+
+def record(name: str, version: str) -> tuple:
+    return f"{name}-{version}-h0_0.conda", {"name": name, "version": version, "build": "h0_0", "build_number": 0,
+                                            "depends": [], "subdir": "linux-64"}
+
+
+def write_repodata(channel_dir: str, packages: dict, with_zst: bool):
+    os.makedirs(os.path.join(channel_dir, "linux-64"), exist_ok=True)
+    body = json.dumps({"info": {"subdir": "linux-64"}, "packages": {}, "packages.conda": packages}).encode()
+    with open(os.path.join(channel_dir, "linux-64", "repodata.json"), mode="wb") as f:
+        f.write(body)
+    zst_path = os.path.join(channel_dir, "linux-64", "repodata.json.zst")
+    if with_zst:
+        with open(zst_path, mode="wb") as f:
+            f.write(zstd.ZstdCompressor().compress(body))
+    elif os.path.exists(zst_path):
+        os.remove(zst_path)
+
+
+if __name__ == "__main__":
+    channel_dir = tempfile.mkdtemp()
+    work_dir = tempfile.mkdtemp()
+    json_path = zst_json_path = os.path.join(work_dir, "repodata_linux-64.json")
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), partial(ChannelHandler, directory=channel_dir))
+    server.requests_log = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/linux-64/repodata.json"
+
+    packages = {"zlib-1.3.1-hb9d3cd8_2.conda": {"name": "zlib", "version": "1.3.1", "build": "hb9d3cd8_2"}}
+
+    # 1. .zst があればそちらを取って展開して保存する
+    write_repodata(channel_dir, packages, with_zst=True)
+    assert fetch_repodata(url, json_path) is True
+    with open(json_path, mode="r") as f:
+        assert json.load(f)["packages.conda"] == packages
+    assert load_fetch_state(json_path)["has_zst"] is True
+    print("zst download:", server.requests_log[-1])
+
+    # 2. 変わっていなければ 304 で何も書き換えない
+    mtime = os.stat(json_path).st_mtime_ns
+    assert fetch_repodata(url, json_path) is False
+    assert os.stat(json_path).st_mtime_ns == mtime
+    print("not modified:", server.requests_log[-1])
+
+    # 3. サーバ側が変わったら取り直す
+    packages["zlib-1.3.2-hb9d3cd8_0.conda"] = {"name": "zlib", "version": "1.3.2", "build": "hb9d3cd8_0"}
+    write_repodata(channel_dir, packages, with_zst=True)
+    assert fetch_repodata(url, json_path) is True
+    with open(json_path, mode="r") as f:
+        assert len(json.load(f)["packages.conda"]) == 2
+    print("updated:", server.requests_log[-1])
+
+    # 4. .zst が無いチャンネルは repodata.json にフォールバックし，次回からは .zst を試さない
+    json_path = os.path.join(work_dir, "repodata_plain.json")
+    write_repodata(channel_dir, packages, with_zst=False)
+    assert fetch_repodata(url, json_path) is True
+    assert load_fetch_state(json_path)["has_zst"] is False
+    del server.requests_log[:]
+    assert fetch_repodata(url, json_path) is False
+    assert server.requests_log == ["GET /linux-64/repodata.json HTTP/1.1"]
+    print("plain fallback:", server.requests_log[-1])
+
+    # 5. 最後の部分が同じでも別のチャンネルならファイル名が分かれる
+    assert channel_name("conda-forge") == channel_name("https://conda.anaconda.org/conda-forge/")
+    assert channel_name("https://conda.anaconda.org/conda-forge") != channel_name("https://mirror.example/x/conda-forge")
+    assert channel_name("https://mirror.example/x/conda-forge").startswith("conda-forge-")
+    print("channel names:", channel_name("conda-forge"), channel_name("https://mirror.example/x/conda-forge"))
+
+    # 6. 5xx は繋がらないのと同じ: .zst がだめなら .json を試し，どちらもだめなら手元のものを使う
+    server.failing = {"/linux-64/repodata.json.zst": 503}
+    del server.requests_log[:]
+    assert fetch_repodata(url, zst_json_path) is True
+    assert sorted(set(line.split()[1] for line in server.requests_log)) == ["/linux-64/repodata.json", "/linux-64/repodata.json.zst"]
+    assert load_fetch_state(zst_json_path)["has_zst"] is True
+    server.failing["/linux-64/repodata.json"] = 500
+    mtime = os.stat(zst_json_path).st_mtime_ns
+    assert fetch_repodata(url, zst_json_path) is False
+    assert os.stat(zst_json_path).st_mtime_ns == mtime
+    try:
+        fetch_repodata(url, os.path.join(work_dir, "repodata_missing.json"))
+        assert False
+    except requests.HTTPError as e:
+        print("server error without a local copy:", e)
+    server.failing = {}
+    print("server error:", server.requests_log)
+
+    # 7. 複数チャンネル: channels × subdirs を並行に取り，同じ名前は優先度の高いチャンネルのものだけ使う
+    write_channel(os.path.join(channel_dir, "high"), dict([record("zlib", "1.0")]))
+    write_channel(os.path.join(channel_dir, "low"), dict([record("zlib", "2.0"), record("bzip2", "1.0")]))
+    slow = ThreadingHTTPServer(("127.0.0.1", 0), partial(SlowChannelHandler, directory=channel_dir))
+    slow.requests_log = []
+    slow.lock = threading.Lock()
+    slow.in_flight = slow.max_in_flight = 0
+    threading.Thread(target=slow.serve_forever, daemon=True).start()
+    high = f"http://127.0.0.1:{slow.server_port}/high/"
+    low = f"http://127.0.0.1:{slow.server_port}/low/"
+
+    repodata = RepoData(path=tempfile.mkdtemp(), channels=[high, low], sharded=False)
+    assert [(r.version, r.channel) for r in repodata._get_records("zlib")] == [("1.0", high)]
+    assert [(r.version, r.channel) for r in repodata._get_records("bzip2")] == [("1.0", low)]
+    assert slow.max_in_flight > 1, slow.max_in_flight
+    print("channel priority:", repodata._get_records("zlib")[0], "in flight:", slow.max_in_flight)
+
+    repodata = RepoData(path=tempfile.mkdtemp(), channels=[low, high], sharded=False)
+    assert [(r.version, r.channel) for r in repodata._get_records("zlib")] == [("2.0", low)]
+    slow.shutdown()
+
+    server.shutdown()
+    print("ok")
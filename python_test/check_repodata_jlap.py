@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import hashlib
+import tempfile
+import threading
+import repodata_cache
+from functools import partial
+from http.server import ThreadingHTTPServer
+from check_repodata_fetch import ChannelHandler, write_repodata
+from check_solver import PACKAGES, package
+from repodata_cache import load_name_index, read_cache, source_fingerprint, update_cache
+from repodata_fetch import load_fetch_state, _save_fetch_state
+from repodata_jlap import fetch_repodata_jlap, apply_patch
+
+# ローカルの HTTP サーバに repodata.jlap を置いて，差分を当てたときに変わった名前だけ索引が作り直されるか確認する
+
+
+class RangeHandler(ChannelHandler):
+    """
+    ChannelHandler に Range: bytes=<start>- を足したもの
+    """
+    def send_head(self):
+        range_header = self.headers.get("Range")
+        path = self.translate_path(self.path)
+        if not range_header or not os.path.isfile(path):
+            return super().send_head()
+
+        start = int(range_header.split("=", 1)[1].rstrip("-"))
+        with open(path, mode="rb") as f:
+            body = f.read()
+        if start >= len(body):
+            self.send_response(416)
+            self.end_headers()
+            return None
+        self.server.requests_log.append(f"Range {range_header}")
+        self.send_response(206)
+        self.send_header("Content-Length", str(len(body) - start))
+        self.end_headers()
+        self.wfile.write(body[start:])
+        return None
+
+
+def blake2_256(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=32).hexdigest()
+
+
+def write_jlap(channel_dir: str, patches: list, latest: str):
+    """
+    patches ([{"from", "to", "patch"}, ...]) を hash の鎖を付けて linux-64/repodata.jlap に書く
+    """
+    iv = bytes(32)
+    lines = [iv.hex().encode()]
+    key = iv
+    for line in [json.dumps(patch).encode() for patch in patches] + [json.dumps({"url": "repodata.json", "latest": latest}).encode()]:
+        lines.append(line)
+        key = hashlib.blake2b(line, key=key, digest_size=32).digest()
+    lines.append(key.hex().encode())
+    with open(os.path.join(channel_dir, "linux-64", "repodata.jlap"), mode="wb") as f:
+        f.write(b"\n".join(lines) + b"\n")
+
+
+def server_repodata(channel_dir: str):
+    with open(os.path.join(channel_dir, "linux-64", "repodata.json"), mode="rb") as f:
+        body = f.read()
+    return json.loads(body), blake2_256(body)
+
+
+if __name__ == "__main__":
+    channel_dir = tempfile.mkdtemp()
+    work_dir = tempfile.mkdtemp()
+    json_path = os.path.join(work_dir, "repodata_linux-64.json")
+    cache_path = os.path.join(work_dir, "repodata_linux-64.cache")
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), partial(RangeHandler, directory=channel_dir))
+    server.requests_log = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/linux-64/repodata.json"
+
+    # JSON patch 単体
+    doc = {"a": {"b~c": [1, 2]}, "d": "x"}
+    doc = apply_patch(doc, [{"op": "add", "path": "/a/b~0c/1", "value": 9},
+                            {"op": "move", "from": "/d", "path": "/a/e"},
+                            {"op": "copy", "from": "/a/e", "path": "/f~1g"},
+                            {"op": "test", "path": "/f~1g", "value": "x"},
+                            {"op": "remove", "path": "/a/b~0c/0"}])
+    assert doc == {"a": {"b~c": [9, 2], "e": "x"}, "f/g": "x"}
+
+    # 0. 初回は repodata.json を取ってキャッシュを作る
+    write_repodata(channel_dir, PACKAGES, with_zst=False)
+    repodata, h0 = server_repodata(channel_dir)
+    assert fetch_repodata_jlap(url, json_path) is True
+    assert load_fetch_state(json_path)["blake2_256"] == h0
+    load_name_index(json_path, cache_path, background=False)
+    before = dict(read_cache(json_path, cache_path)._table)
+
+    # 1. python_abi を 1 件足す patch: jlap だけ取り，python_abi だけ索引を作り直す
+    filename, info = package("python_abi", "3.14", "8_cp314")
+    patch1 = [{"op": "add", "path": f"/packages.conda/{filename}", "value": info}]
+    repodata = apply_patch(repodata, patch1)
+    write_repodata(channel_dir, repodata["packages.conda"], with_zst=False)
+    _, h1 = server_repodata(channel_dir)
+    write_jlap(channel_dir, [{"from": h0, "to": h1, "patch": patch1}], h1)
+
+    del server.requests_log[:]
+    old_index = read_cache(json_path, cache_path)
+    assert fetch_repodata_jlap(url, json_path) is True
+    assert not any("repodata.json" in line for line in server.requests_log)
+    # キャッシュは置き換えなので，前のキャッシュを mmap しているものはそのまま読める
+    assert sorted(row[2] for row in old_index.get("python_abi")) == ["3.12", "3.13"]
+    with open(json_path, mode="r") as f:
+        assert json.load(f) == repodata
+    index = read_cache(json_path, cache_path)
+    assert index is not None
+    changed = {name for name in index._table if index._table[name] != before.get(name)}
+    assert changed == {"python_abi"}, changed
+    assert sorted(row[2] for row in index.get("python_abi")) == ["3.12", "3.13", "3.14"]
+    print("patch 1:", server.requests_log)
+
+    # 2. scipy を消す patch を追記: 前回の続きだけを Range で取る
+    scipy_key = [key for key, info in repodata["packages.conda"].items() if info["name"] == "scipy"][0]
+    patch2 = [{"op": "remove", "path": f"/packages.conda/{scipy_key}"}]
+    repodata = apply_patch(repodata, patch2)
+    write_repodata(channel_dir, repodata["packages.conda"], with_zst=False)
+    _, h2 = server_repodata(channel_dir)
+    write_jlap(channel_dir, [{"from": h0, "to": h1, "patch": patch1}, {"from": h1, "to": h2, "patch": patch2}], h2)
+
+    del server.requests_log[:]
+    before = dict(index._table)
+    assert fetch_repodata_jlap(url, json_path) is True
+    assert any(line.startswith("Range") for line in server.requests_log)
+    index = read_cache(json_path, cache_path)
+    assert "scipy" not in index
+    assert {name for name in index._table if index._table[name] != before.get(name)} == set()
+    print("patch 2:", server.requests_log)
+
+    # バックグラウンドでキャッシュを書いている途中なら update_cache は何もしない
+    release = threading.Event()
+    writer = threading.Thread(target=release.wait)
+    writer.start()
+    repodata_cache._background_writes[os.path.abspath(cache_path)] = writer
+    assert update_cache(json_path, cache_path, source_fingerprint(json_path), {"scipy": []}) is False
+    release.set()
+    writer.join()
+    assert update_cache(json_path, cache_path, source_fingerprint(json_path), {}) is True
+
+    # 3. 変わっていなければ何もしない
+    fingerprint = source_fingerprint(json_path)
+    assert fetch_repodata_jlap(url, json_path) is False
+    assert source_fingerprint(json_path) == fingerprint
+
+    # 4. 手元の hash が jlap に無ければ repodata.json を取り直す
+    state = load_fetch_state(json_path)
+    state["blake2_256"] = "00" * 32
+    _save_fetch_state(json_path, state)
+    del server.requests_log[:]
+    assert fetch_repodata_jlap(url, json_path) is True
+    assert any("repodata.json" in line for line in server.requests_log)
+    assert load_fetch_state(json_path)["blake2_256"] == h2
+    print("fallback:", server.requests_log)
+
+    # 5. jlap の 5xx や壊れた鎖は今回だけ repodata.json に回り，次回はまた jlap を試す
+    server.failing = {"/linux-64/repodata.jlap": 503}
+    del server.requests_log[:]
+    assert fetch_repodata_jlap(url, json_path) is False
+    assert any("repodata.json" in line for line in server.requests_log)
+    assert "has_jlap" not in load_fetch_state(json_path)
+    server.failing = {}
+
+    with open(os.path.join(channel_dir, "linux-64", "repodata.jlap"), mode="rb") as f:
+        jlap_body = f.read()
+    with open(os.path.join(channel_dir, "linux-64", "repodata.jlap"), mode="ab") as f:
+        f.write(b"broken\n")
+    state = load_fetch_state(json_path)
+    state.pop("jlap", None)
+    _save_fetch_state(json_path, state)
+    fetch_repodata_jlap(url, json_path)
+    assert "has_jlap" not in load_fetch_state(json_path)
+
+    with open(os.path.join(channel_dir, "linux-64", "repodata.jlap"), mode="wb") as f:
+        f.write(jlap_body)
+    del server.requests_log[:]
+    assert fetch_repodata_jlap(url, json_path) is False
+    assert server.requests_log == ["GET /linux-64/repodata.jlap HTTP/1.1"], server.requests_log
+    print("transient errors:", server.requests_log)
+
+    # 6. jlap が無い (404) なら次回から jlap を試さない
+    os.remove(os.path.join(channel_dir, "linux-64", "repodata.jlap"))
+    fetch_repodata_jlap(url, json_path)
+    assert load_fetch_state(json_path)["has_jlap"] is False
+
+    server.shutdown()
+    print("ok")
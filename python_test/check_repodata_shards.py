@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+import os
+import hashlib
+import tempfile
+import threading
+import msgpack
+import zstandard as zstd
+from functools import partial
+from http.server import ThreadingHTTPServer
+from check_repodata_fetch import ChannelHandler, write_repodata
+from check_repodata_v3 import RepoData
+from solver import Solver
+from check_solver import PACKAGES
+
+# ローカルの HTTP サーバに sharded repodata (CEP-16) を置いて，RepoData がシャードを必要な分だけ取るか確認する
+
+
+def write_sharded_repodata(channel_dir: str, subdir: str, packages: dict):
+    """
+    packages ({filename: record}) を名前ごとのシャードと索引にして channel_dir/subdir に書く
+    """
+    shards_dir = os.path.join(channel_dir, subdir, "shards")
+    os.makedirs(shards_dir, exist_ok=True)
+
+    by_name = {}
+    for filename, info in packages.items():
+        info = dict(info, sha256=hashlib.sha256(filename.encode()).digest(),
+                    md5=hashlib.md5(filename.encode()).digest())
+        by_name.setdefault(info["name"], {})[filename] = info
+
+    shards = {}
+    for name, records in by_name.items():
+        data = zstd.ZstdCompressor().compress(msgpack.packb({"packages": {}, "packages.conda": records}))
+        digest = hashlib.sha256(data).digest()
+        with open(os.path.join(shards_dir, digest.hex() + ".msgpack.zst"), mode="wb") as f:
+            f.write(data)
+        shards[name] = digest
+
+    shard_index = {"version": 1, "info": {"base_url": "", "shards_base_url": "./shards/", "subdir": subdir},
+                   "shards": shards}
+    with open(os.path.join(channel_dir, subdir, "repodata_shards.msgpack.zst"), mode="wb") as f:
+        f.write(zstd.ZstdCompressor().compress(msgpack.packb(shard_index)))
+
+    return shards
+
+
+if __name__ == "__main__":
+    channel_dir = tempfile.mkdtemp()
+    work_dir = tempfile.mkdtemp()
+    shards = write_sharded_repodata(channel_dir, "linux-64", PACKAGES)
+    write_sharded_repodata(channel_dir, "noarch", {})
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), partial(ChannelHandler, directory=channel_dir))
+    server.requests_log = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    channel = f"http://127.0.0.1:{server.server_port}/"
+
+    # 1. repodata.json は取らず，solver が辿った名前のシャードだけを取る
+    repodata = RepoData(path=work_dir, channels=[channel])
+    result = Solver(repodata).solve(["numpy"])
+    assert {p.name for p in result} == {"numpy", "python", "python_abi", "libzlib"}
+    assert not any("repodata.json" in line for line in server.requests_log)
+    fetched = {line.split()[1].rsplit("/", 1)[-1] for line in server.requests_log if "/shards/" in line}
+    assert fetched == {shards[name].hex() + ".msgpack.zst" for name in ("numpy", "python", "python_abi", "libzlib")}
+    numpy = [p for p in result if p.name == "numpy"][0]
+    assert numpy.sha256 == hashlib.sha256(numpy.package_name.encode()).hexdigest()
+    print("shards fetched:", len(fetched), "of", len(shards))
+
+    # 2. 2 回目は索引が 304，シャードは sha256 の名前でキャッシュにあるので取らない
+    del server.requests_log[:]
+    repodata = RepoData(path=work_dir, channels=[channel])
+    Solver(repodata).solve(["numpy"])
+    assert not any("/shards/" in line for line in server.requests_log)
+    print("cached:", server.requests_log)
+
+    # 3. 中身と sha256 が合わないシャードは使わない
+    with open(os.path.join(channel_dir, "linux-64", "shards", shards["scipy"].hex() + ".msgpack.zst"), mode="ab") as f:
+        f.write(b"broken")
+    try:
+        RepoData(path=work_dir, channels=[channel])._get_records("scipy")
+        assert False
+    except ValueError as e:
+        print("tampered:", e)
+
+    # 4. sharded repodata が無いチャンネルは repodata.json にフォールバックする
+    os.remove(os.path.join(channel_dir, "linux-64", "repodata_shards.msgpack.zst"))
+    os.remove(os.path.join(channel_dir, "noarch", "repodata_shards.msgpack.zst"))
+    write_repodata(channel_dir, PACKAGES, with_zst=False)
+    os.makedirs(os.path.join(channel_dir, "noarch"), exist_ok=True)
+    with open(os.path.join(channel_dir, "noarch", "repodata.json"), mode="w") as f:
+        f.write('{"packages": {}, "packages.conda": {}}')
+    repodata = RepoData(path=tempfile.mkdtemp(), channels=[channel])
+    assert [p.version for p in repodata._get_records("numpy")] == ["2.2.6", "2.2.6", "2.3.1", "2.3.1"]
+    print("fallback:", [line for line in server.requests_log if "repodata.json" in line][-1])
+
+    server.shutdown()
+    print("ok")
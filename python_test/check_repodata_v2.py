@@ -99,6 +99,20 @@ class PackageMetaInfo:
 
         return pmi
 
+def _range_to_conditions(_range):
+    """
+    connect_version が返す VersionRange を，このファイルで使う条件のリスト ([">=3.10", "<3.11"] / ["3.13"]) に戻す
+    区間が 2 つ以上あるもの (| や != の穴) はリストでは表せないので None
+    """
+    if len(_range.intervals) != 1:
+        return None
+    conditions = str(_range)
+    if conditions == "*":
+        return []
+    if conditions.startswith("=="):
+        return [conditions[2:]]
+    return conditions.split(",")
+
 def compare_to(package1, package2):
     """
     name・version・buildが一致 or 条件に合うかを判定する
@@ -115,6 +129,7 @@ def compare_to(package1, package2):
         if not res_connect_version:
             print("Version are conflict !!!!!")
             return None
+        res_connect_version = _range_to_conditions(res_connect_version)
 
     # # ---------- build ----------
     # if hasattr(self, "build") and hasattr(other, "build"):
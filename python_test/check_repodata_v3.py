@@ -4,6 +4,8 @@ import sys
 import os
 import time
 import json
+import marshal
+import hashlib
 import requests
 from IPython import embed
 from urllib.parse import urljoin
@@ -12,9 +14,26 @@ import shutil
 import tarfile
 import zstandard as zstd
 import re
+try:
+    import numpy as np
+except ImportError:
+    np = None
+from functools import lru_cache
+from typing import NamedTuple
 from packaging.version import Version
 from pprint import pprint
-from version_check import LooseVersion, connect_version
+from bisect import bisect_left, bisect_right
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from version_check import (LooseVersion, VersionRange, NEG_INF, POS_INF,
+                           parse_version, version_key)
+from repodata_cache import RECORD_FIELDS, record_row, load_name_index, source_fingerprint
+from repodata_fetch import channel_url, channel_name, make_session, load_fetch_state
+from repodata_shards import load_shard_index, MAX_SHARD_WORKERS
+from repodata_jlap import fetch_repodata_jlap
+from solve_cache import SolveCache, solve_key
+from check_repodata import (download_and_extract_packages, install_package,
+                            load_conda_meta, write_conda_meta, remove_package, verify_prefix)
 
 base_conda_forge_donwload_url = "https://conda.anaconda.org/conda-forge/"
 base_anaconda_donwload_url = "https://repo.anaconda.com/pkgs/main/"
@@ -48,172 +67,461 @@ class PackageMetaInfo:
     'version': '2.19.0'
     }
     """
-    # package_name: str = None
-    # name: str = None
-    # version = None
+    __slots__ = RECORD_FIELDS + ("channel",)
+
     def __repr__(self):
         return f"PackageMetaInfo(name={self.name!r}, version={self.version!r}, build={self.build!r})"
 
+    def __getattr__(self, key):
+        # license / track_features / constrains など滅多に使わないキーは
+        # 初めて参照されたときに extra (marshal bytes) から decode する
+        if key.startswith("__") or key in PackageMetaInfo.__slots__:
+            raise AttributeError(key)
+        extra = self.extra
+        if not isinstance(extra, dict):
+            extra = marshal.loads(extra) if extra else {}
+            self.extra = extra
+        try:
+            return extra[key]
+        except KeyError:
+            raise AttributeError(key) from None
+
     @staticmethod
-    def from_repodata(key: str, info: dict) -> "PackageMetaInfo":
+    def from_row(row: tuple, channel: str = None) -> "PackageMetaInfo":
 
         pmi = PackageMetaInfo()
-        pmi.package_name = key
+        (pmi.package_name, pmi.name, pmi.version, pmi.build, pmi.build_number, pmi.depends,
+         pmi.subdir, pmi.timestamp, pmi.md5, pmi.sha256, pmi.size, pmi.extra) = row
+        pmi.channel = channel
 
-        # repodata のすべてのキーを属性として追加
-        for key, value in info.items():
-            setattr(pmi, key, value)
-        
         return pmi
 
-class SearchInfo():
-    
+    @staticmethod
+    def from_repodata(key: str, info: dict, channel: str = None) -> "PackageMetaInfo":
+
+        return PackageMetaInfo.from_row(record_row(key, info), channel)
+
+    def to_package_dict(self) -> dict:
+        """
+        ダウンロード・インストール・conda-meta 用の dict（check_repodata の package と同じキー）
+        """
+        channel = self.channel or base_conda_forge_donwload_url
+        return {
+            "filename.conda": self.package_name,
+            "filename": self.package_name[:-len(".conda")],
+            "url": urljoin(channel, f"{self.subdir}/{self.package_name}"),
+            "channel": channel,
+            "name": self.name,
+            "version": self.version,
+            "build": self.build,
+            "build_number": self.build_number,
+            "depends": list(self.depends),
+            "constrains": list(getattr(self, "constrains", [])),
+            "subdir": self.subdir,
+            "timestamp": self.timestamp,
+            "md5": self.md5,
+            "sha256": self.sha256,
+            "size": self.size,
+        }
+
+def record_key(record: PackageMetaInfo) -> tuple:
+    """
+    同じ名前のレコードを並べるときの key: (バージョン, build_number, timestamp)
+    パースできないバージョンは一番小さいものとして扱う
+    """
+    try:
+        _version_key = version_key(record.version)
+    except ValueError:
+        _version_key = (float('-inf'),)
+    return (_version_key, int(record.build_number or 0), record.timestamp or 0)
+
+
+class VersionInfo(NamedTuple):
+    """
+    依存文字列のバージョン条件．upper_version / lower_version はパース済みの LooseVersion
+    """
+    upper: str = None
+    upper_operator: str = None
+    lower: str = None
+    lower_operator: str = None
+    upper_version: LooseVersion = None
+    lower_version: LooseVersion = None
+    range: VersionRange = None
+
+    def __repr__(self):
+        return f"VersionInfo(upper={self.upper}, upper_opertor={self.upper_operator}, lower={self.lower}, lower_operator={self.lower_operator})"
+
+
+class SearchInfo(NamedTuple):
+    name: str
+    version: VersionInfo
+    build: str = None
+
     def __repr__(self):
         return f"SearchInfo(name={self.name!r}, version={self.version!r}, build={self.build!r})"
 
     @staticmethod
-    def from_depend_format(depend: str):
-        class VersionInfo:
-            def __repr__(self):
-                return f"VersionInfo(upper={self.upper}, upper_opertor={self.upper_operator}, lower={self.lower}, lower_operator={self.lower_operator})"
-            upper = None
-            upper_operator = None
-            lower = None
-            lower_operator = None
-        
-
-        pattern = r"^([A-Za-z0-9_\-\.\+]+)(?:\s+([^\s]+))?(?:\s+([^\s]+))?$"
-        match = re.match(pattern, depend)
-        name, versions, build = match.groups()
-
-        if not versions:
-            di = SearchInfo()
-            setattr(di, "name", name)
-            setattr(di, "version", VersionInfo())
-            setattr(di, "build", build)
-
-            return di
-            
-        versions = versions.split(',')
-        # get min max
-        version_info = VersionInfo()
-        for version in versions:
-            match = re.match(r"(<=|>=|=|!=|<|>)(.+)", version.strip())
-            if not match:
-                print("include only number")
-                version_info.lower = version
-                version_info.lower_operator = None
-                version_info.upper = version
-                version_info.upper_operator = None
-                
-            else:
-                operator, ver = match.groups()
-                debug_print(operator, ver)
-                if ">" in operator:
-                    version_info.lower = ver
-                    version_info.lower_operator = operator
-                elif "<" in operator:
-                    version_info.upper = ver
-                    version_info.upper_operator = operator
-                else:
-                    debug_print("no operator found: ", operator, ver)
-
-        di = SearchInfo()
-        setattr(di, "name", name)
-        setattr(di, "version", version_info)
-        setattr(di, "build", build)
-
-        return di
+    def from_depend_format(depend: str) -> "SearchInfo":
+        return parse_depend(depend)
+
+
+DEPEND_PATTERN = re.compile(r"^([A-Za-z0-9_\-\.\+]+)(?:\s+([^\s]+))?(?:\s+([^\s]+))?$")
+VERSION_CONDITION_PATTERN = re.compile(r"(<=|>=|=|!=|<|>)(.+)")
+SPEC_CACHE_SIZE = 65536
+
+ANY_VERSION = VersionRange.any()
+
+def _conditions_range(conditions: VersionInfo):
+    """
+    conditions の VersionRange．条件が何もなければ全部，パースできなかった条件なら None
+    """
+    if conditions.range is not None:
+        return conditions.range
+    if conditions.upper is None and conditions.lower is None:
+        return ANY_VERSION
+    return None
+
+def _match_any(build: str) -> bool:
+    return True
+
+@lru_cache(maxsize=SPEC_CACHE_SIZE)
+def build_matcher(build_spec: str):
+    """
+    "*_cp310" や "cuda124_*" のようなビルドの指定を，ビルド文字列 -> bool の関数にする
+    * が端に 1 つだけなら endswith / startswith，それ以外は * を .* にした正規表現 (他の文字はそのまま比べる)
+    同じ指定は何度も出てくるのでキャッシュして使い回す
+    """
+    if "*" not in build_spec:
+        return build_spec.__eq__
+    if build_spec.strip("*") == "":
+        return _match_any
+
+    if build_spec.count("*") == 1:
+        if build_spec.startswith("*"):
+            suffix = build_spec[1:]
+            return lambda build: build.endswith(suffix)
+        if build_spec.endswith("*"):
+            prefix = build_spec[:-1]
+            return lambda build: build.startswith(prefix)
+
+    pattern = re.compile(".*".join(re.escape(part) for part in build_spec.split("*")), re.DOTALL)
+    return lambda build: pattern.fullmatch(build) is not None
+
+def _parse_version_or_none(version: str):
+    # パースできない文字列は比較するときに改めてエラーにする
+    try:
+        return parse_version(version)
+    except ValueError:
+        return None
+
+@lru_cache(maxsize=SPEC_CACHE_SIZE)
+def parse_depend(depend: str) -> SearchInfo:
+    """
+    "python >=3.10,<3.11.0a0" のような依存文字列を SearchInfo にする
+    同じ文字列は何千回も出てくるので結果をキャッシュする（SearchInfo / VersionInfo は immutable）
+    """
+    match = DEPEND_PATTERN.match(depend)
+    name, versions, build = match.groups()
+
+    if not versions:
+        return SearchInfo(name, VersionInfo(), build)
+
+    # get min max
+    upper = upper_operator = lower = lower_operator = None
+    for version in versions.split(','):
+        match = VERSION_CONDITION_PATTERN.match(version.strip())
+        if not match:
+            # include only number
+            lower = upper = version
+            lower_operator = upper_operator = None
+            continue
+
+        operator, ver = match.groups()
+        if ">" in operator:
+            lower = ver
+            lower_operator = operator
+        elif "<" in operator:
+            upper = ver
+            upper_operator = operator
+
+    # != や "=3.13"，"|" も含めた正確な範囲．パースできなければ None
+    try:
+        _range = VersionRange.from_spec(versions)
+    except ValueError:
+        _range = None
+
+    version_info = VersionInfo(upper, upper_operator, lower, lower_operator,
+                               _parse_version_or_none(upper) if upper_operator else None,
+                               _parse_version_or_none(lower) if lower_operator else None,
+                               _range)
+
+    return SearchInfo(name, version_info, build)
     
 
-def compare_to(package1, package2):
+def compute_transaction(installed: dict, targets: list):
     """
-    name・version・buildが一致 or 条件に合うかを判定する
+    conda-meta から読んだ installed (name -> record) と解決結果 targets (PackageMetaInfo) を比べて
+    (追加する PackageMetaInfo, 削除する record, そのままの PackageMetaInfo) を返す
+    バージョン違いで入れ替えるものは削除と追加の両方に入る
     """
-    # ---------- name ----------
-    if hasattr(package1, "name") and hasattr(package2, "name"):
-        if package1.name != package2.name:
-            return None
+    to_add, to_remove, unchanged = [], [], []
+    target_names = set()
+    for target in targets:
+        if target.name in target_names:
+            continue
+        target_names.add(target.name)
 
-    # ---------- version ----------
-    if hasattr(package1, "version") and hasattr(package2, "version"):
-        res_connect_version = connect_version(package1.version, package2.version)
-        if not res_connect_version:
-            print("Version are conflict !!!!!")
-            return None
+        record = installed.get(target.name)
+        if record and record.get("fn") == target.package_name:
+            unchanged.append(target)
+            continue
+        if record:
+            to_remove.append(record)
+        to_add.append(target)
 
-    # # ---------- build ----------
-    # if hasattr(self, "build") and hasattr(other, "build"):
-    #     # 完全一致
-    #     if self.build != other.build:
-    #         # 一致しない場合は prefix 一致など条件付き一致にも対応
-    #         if not self.build.startswith(other.build) and not other.build.startswith(self.build):
-    #             return False
+    to_remove += [record for name, record in installed.items() if name not in target_names]
 
-    return res_connect_version
-        
+    return to_add, to_remove, unchanged
 
-class RepoData():
-    def __init__(self, path='.'):
 
-        self.repodata = self._download_repodata_json(path)
+def install_targets(targets: list, prefix=".prefix", cd=".cache", verify=False):
+    """
+    prefix を targets の状態にする．conda-meta と比べて変わったパッケージだけ削除・追加する
+    先に追加するものを全部ダウンロード・展開してから消すので，ダウンロードや hash の確認で失敗しても prefix はそのまま
+    verify なら変わらないパッケージも conda-meta の paths_data で確かめ，ファイルが無い・合わないものは入れ直す
+    """
+    installed = load_conda_meta(prefix)
+    to_add, to_remove, unchanged = compute_transaction(installed, targets)
+    if verify and unchanged:
+        broken = verify_prefix(prefix, {target.name for target in unchanged})
+        for name, paths in broken.items():
+            print(f"broken: {name} ({len(paths)} files)")
+        to_add += [target for target in unchanged if target.name in broken]
+        unchanged = [target for target in unchanged if target.name not in broken]
+    print(f"transaction: {len(to_add)} to add, {len(to_remove)} to remove, {len(unchanged)} unchanged")
+
+    packages = [target.to_package_dict() for target in to_add]
+    if packages:
+        download_and_extract_packages(packages, cd)
+
+    for record in to_remove:
+        print("remove: ", record["fn"])
+        remove_package(record, prefix)
+
+    for package in packages:
+        paths = install_package(package["filename"], prefix, cd)
+        write_conda_meta(package, paths, prefix)
+
+    return to_add, to_remove, unchanged
+
+
+# これ以上レコードのある名前 (python / libgcc など) は NumPy でまとめてバージョンを比べる
+VECTORIZE_MIN_RECORDS = 64
+VERSION_PAD = -1
+
+def _version_array(keys: list):
+    """
+    バージョンの key (数字の tuple) を VERSION_PAD で埋めた固定幅の int64 配列にする
+    (3, 10) -> [3, 10, -1] なので tuple の比較と同じく (3, 10) < (3, 10, 0) になる
+    inf / -inf を含む key (ワイルドカードやパースできないもの) の行は special を True にして別に扱う
+    """
+    special = np.array([not all(type(k) is int for k in key) for key in keys], dtype=bool)
+    width = max([len(key) for key, s in zip(keys, special) if not s] or [1])
+    array = np.full((len(keys), width), VERSION_PAD, dtype=np.int64)
+    for i, key in enumerate(keys):
+        if not special[i]:
+            array[i, :len(key)] = key
+
+    return array, special
 
-    def _download_repodata_json(self, path):
-        if not "repodata_linux-64.json" in os.listdir(path):
-            response = requests.get("https://conda.anaconda.org/conda-forge/linux-64/repodata.json")
-            _repodata_linux64 = response.json()
-            with open(os.path.join(path, 'repodata_linux-64.json'), mode='w') as f:
-                json.dump(_repodata_linux64, f, indent=2)
 
-        if not "repodata_noarch.json" in os.listdir(path):
-            response = requests.get("https://conda.anaconda.org/conda-forge/noarch/repodata.json")
-            _repodata_noarch = response.json()
-            with open(os.path.join(path, 'repodata_noarch.json'), mode='w') as f:
-                json.dump(_repodata_noarch, f, indent=2)
+def _compare_rows(array, key: tuple):
+    """
+    array の各行と key を辞書順で比べて -1 / 0 / 1 の配列を返す
+    """
+    width = max(array.shape[1], len(key))
+    if array.shape[1] < width:
+        array = np.pad(array, ((0, 0), (0, width - array.shape[1])), constant_values=VERSION_PAD)
+    vector = np.full(width, VERSION_PAD, dtype=np.int64)
+    vector[:len(key)] = key
 
-        with open(os.path.join(path, 'repodata_linux-64.json'), mode="r") as f:
-            _repodata_linux64 = json.load(f)
+    diff = array != vector
+    first = diff.argmax(axis=1)
+    smaller = array[np.arange(len(array)), first] < vector[first]
+    return np.where(diff.any(axis=1), np.where(smaller, -1, 1), 0)
 
-        with open(os.path.join(path, 'repodata_noarch.json'), mode="r") as f:
-            _repodata_noarch = json.load(f)
 
-        _repodata = {'linux-64': _repodata_linux64, 'noarch': _repodata_noarch}
+class RepoData():
+    def __init__(self, path='.', channels=None, subdirs=None, sharded=True):
+        """
+        channels: チャンネルのリスト（先頭ほど優先度が高い．URL か "conda-forge" のような名前）
+        subdirs: 読む subdir のリスト
+        sharded: チャンネルが sharded repodata (CEP-16) に対応していればそちらを使う
+        """
+        self.channels = [channel_url(c) for c in (channels or [base_conda_forge_donwload_url])]
+        self.subdirs = subdirs or ['linux-64', 'noarch']
 
-        return _repodata
+        # チャンネルごとに subdir の索引を持つ．レコードは名前を引いたときに初めて decode される
+        # content_hash は読んだ repodata 全体の中身の hash (解いた結果のキャッシュの key に使う)
+        self.channel_indexes, self.content_hash = self._load_indexes(path, sharded)
+        self.index = {}
+        self.version_keys = {}
+        self.version_arrays = {}
+
+    def _load_indexes(self, path, sharded):
+        """
+        channels × subdirs の索引をスレッドプールで並行に用意する．接続は 1 つの Session のプールを共有する
+        sharded repodata があればシャードの索引だけを取り (シャードは名前を引いたときに取る)，
+        無ければ repodata.json をストリーミング保存してキャッシュ済みの索引を開く
+        既にある repodata.json は repodata.jlap の差分を当てて最新にし，変わった名前だけ索引を更新する
+        (jlap が無ければ ETag / Last-Modified で再検証し，変わっていれば取り直す)
+        (索引のリスト, 全部の索引の中身をまとめた hash) を返す
+        """
+        jobs = [(channel, subdir) for channel in self.channels for subdir in self.subdirs]
+        session = make_session(max(len(jobs), MAX_SHARD_WORKERS))
+
+        def _load(job):
+            channel, subdir = job
+            if sharded:
+                shard_index_path = os.path.join(path, f'repodata_shards_{channel_name(channel)}_{subdir}.msgpack.zst')
+                subdir_index = load_shard_index(channel, subdir, shard_index_path, os.path.join(path, 'shards'), session)
+                if subdir_index is not None:
+                    # シャードは sha256 で引くので，索引の hash が変わらなければ中身も変わらない
+                    with open(shard_index_path, mode='rb') as f:
+                        return subdir_index, hashlib.sha256(f.read()).hexdigest()
+            json_path = os.path.join(path, f'repodata_{channel_name(channel)}_{subdir}.json')
+            fetch_repodata_jlap(urljoin(channel, f'{subdir}/repodata.json'), json_path, session)
+            digest = load_fetch_state(json_path).get('blake2_256') or source_fingerprint(json_path)
+            return load_name_index(json_path), digest
+
+        with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+            _indexes = dict(zip(jobs, executor.map(_load, jobs)))
+
+        content_hash = hashlib.sha256()
+        for job in jobs:
+            content_hash.update(f"{job[0]} {job[1]} {_indexes[job][1]}\n".encode())
+
+        return ([(channel, [_indexes[(channel, subdir)][0] for subdir in self.subdirs])
+                 for channel in self.channels], content_hash.hexdigest())
+
+    def prefetch(self, names):
+        """
+        これから引く名前のシャードを先にまとめて取っておく (sharded でない索引では何もしない)
+        """
+        names = [name for name in names if name not in self.index]
+        if not names:
+            return
+        for channel, subdir_indexes in self.channel_indexes:
+            for subdir_index in subdir_indexes:
+                if hasattr(subdir_index, "prefetch"):
+                    subdir_index.prefetch(names)
+
+    def _get_records(self, name: str) -> list:
+        """
+        パッケージ名 -> [PackageMetaInfo, ...] を全 subdir 分まとめて返す
+        チャンネルは strict priority: その名前を持っている一番優先度の高いチャンネルのレコードだけを使う
+        一度引いた名前は self.index に残すので，検索はその名前のレコード数だけで済む
+        レコードは record_key (バージョン, build_number, timestamp) の昇順に一度だけ並べておき，
+        self.version_keys[name] にバージョンの key を同じ順番で持つ (bisect 用)
+        """
+        records = self.index.get(name)
+        if records is None:
+            records = []
+            for channel, subdir_indexes in self.channel_indexes:
+                records = [PackageMetaInfo.from_row(row, channel)
+                           for subdir_index in subdir_indexes
+                           for row in subdir_index.get(name, ())]
+                if records:
+                    break
+            keys = [record_key(record) for record in records]
+            order = sorted(range(len(records)), key=keys.__getitem__)
+            records = [records[i] for i in order]
+            self.index[name] = records
+            self.version_keys[name] = [keys[i][0] for i in order]
+
+        return records
+
+    def _version_range(self, name: str, conditions: VersionInfo) -> tuple:
+        """
+        conditions の範囲の下端・上端で self.index[name] を bisect して，候補になりうる範囲 [lo, hi) を返す
+        範囲の中も != の穴やバージョン以外の条件 (ビルドなど) は見ていないので，呼ぶ側で確認する
+        """
+        records = self._get_records(name)
+        keys = self.version_keys[name]
+        _range = _conditions_range(conditions)
+        if _range is None:
+            return 0, len(records)
+        if not _range:
+            return 0, 0
+
+        lower, lower_inclusive = _range.intervals[0][:2]
+        upper, upper_inclusive = _range.intervals[-1][2:]
+        lo = bisect_left(keys, lower) if lower_inclusive else bisect_right(keys, lower)
+        hi = bisect_right(keys, upper) if upper_inclusive else bisect_left(keys, upper)
+
+        return lo, max(lo, hi)
+
+    def _version_mask(self, name: str, conditions: VersionInfo):
+        """
+        self.index[name] の全レコードについて conditions を満たすかどうかの bool 配列を NumPy で求める
+        範囲の区間ごとに下端・上端と比べて OR をとる．範囲が分からないときは None (呼ぶ側で 1 つずつ確認する)
+        """
+        records = self._get_records(name)
+        _range = _conditions_range(conditions)
+        if _range is None:
+            return None
+        if name not in self.version_arrays:
+            self.version_arrays[name] = _version_array(self.version_keys[name])
+        array, special = self.version_arrays[name]
+
+        mask = np.zeros(len(records), dtype=bool)
+        for lower, lower_inclusive, upper, upper_inclusive in _range.intervals:
+            interval_mask = ~special
+            if lower != NEG_INF:
+                sign = _compare_rows(array, lower)
+                interval_mask &= (sign >= 0) if lower_inclusive else (sign > 0)
+            if upper != POS_INF:
+                sign = _compare_rows(array, upper)
+                interval_mask &= (sign <= 0) if upper_inclusive else (sign < 0)
+            mask |= interval_mask
+
+        # ワイルドカードなどのレコードだけは 1 つずつ
+        for i in np.flatnonzero(special):
+            try:
+                mask[i] = self._satisfies_version(records[i].version, conditions)
+            except ValueError:
+                mask[i] = False
+
+        return mask
 
     def _satisfies_version(self, version, conditions) -> bool:
         """
         version: 実際のバージョン文字列（例: "2.18"）
-        conditions: 比較条件リスト（例: [">=2.17", "<3.0.a0"]）
+        conditions: 比較条件（VersionInfo）
         """
-        v = LooseVersion(version)
+        _range = _conditions_range(conditions)
+        if _range is not None:
+            return version_key(version) in _range
+
+        v = parse_version(version)
+        upper = conditions.upper_version or (conditions.upper_operator and parse_version(conditions.upper))
+        lower = conditions.lower_version or (conditions.lower_operator and parse_version(conditions.lower))
         if conditions.upper_operator == "<":
-            if not v < LooseVersion(conditions.upper):
-                debug_print("v: ", v)
-                debug_print("upper: ", LooseVersion(conditions.upper))
-                debug_print(v < LooseVersion(conditions.upper))
+            if not v < upper:
                 return False
         elif conditions.upper_operator == "<=":
-            if not v <= LooseVersion(conditions.upper):
-                debug_print("v: ", v)
-                debug_print("upper: ", LooseVersion(conditions.upper))
-                debug_print(v <= LooseVersion(conditions.upper))
+            if not v <= upper:
                 return False
         if conditions.lower_operator == ">":
-            if not v > LooseVersion(conditions.lower):
-                debug_print("v: ", v)
-                debug_print("lower: ", LooseVersion(conditions.lower))
-                debug_print(v > LooseVersion(conditions.lower))
+            if not v > lower:
                 return False
         elif conditions.lower_operator == ">=":
-            if not v >= LooseVersion(conditions.lower):
-                debug_print("v:", v)
-                debug_print("lower: ", LooseVersion(conditions.lower))
-                debug_print(v >= LooseVersion(conditions.lower))
+            if not v >= lower:
                 return False
 
-        if conditions.lower_operator == None and conditions.upper_operator == None:
-            print("only number")
+        # only number ("3.13.*" や "1.2.3") は一致するかどうか
+        if conditions.lower_operator == None and conditions.upper_operator == None and conditions.lower is not None:
+            return v == parse_version(conditions.lower)
 
         return True
 
@@ -255,84 +563,178 @@ class RepoData():
                     return False
         """
 
-    def _satisfies_build(self, repo_build, target_build):
-        if repo_build == target_build:
-            return True
-        else:
-            if "*" in target_build:
-                match_hash = target_build.split("*")
-                print(f"match_hash: {match_hash} | repo_build {repo_build}")
-                for _hash in match_hash:
-                    # if not _hash in repo_build:
-                    print(f"repo_build.end_with: {repo_build.endswith(_hash)}")
-                    if not repo_build.endswith(_hash):
-                        return False
+    def _matches(self, record: PackageMetaInfo, target_package: SearchInfo) -> bool:
+        try:
+            if not self._satisfies_version(record.version, target_package.version):
+                return False
+        except ValueError:
+            return False
+        if target_package.build and not build_matcher(target_package.build)(record.build):
+            return False
+        return True
+
+    def find_candidates(self, target_package: SearchInfo) -> list:
+        """
+        target_package のバージョンとビルドの条件に合うレコードを record_key の昇順で全部返す
+        バージョンの範囲は bisect で絞り，その中だけを前から順に確認する (NumPy があればまとめて mask で絞る)
+        バージョンがパースできないレコードは候補にしない
+        """
+        records = self._get_records(target_package.name)
+
+        # レコードの多い名前は NumPy の mask でバージョンをまとめて絞り，ビルドだけ 1 つずつ見る
+        if np is not None and len(records) >= VECTORIZE_MIN_RECORDS:
+            mask = self._version_mask(target_package.name, target_package.version)
+            if mask is not None:
+                if not target_package.build:
+                    return [records[i] for i in np.flatnonzero(mask)]
+                match = build_matcher(target_package.build)
+                return [records[i] for i in np.flatnonzero(mask) if match(records[i].build)]
+
+        lo, hi = self._version_range(target_package.name, target_package.version)
+
+        return [record for record in records[lo:hi] if self._matches(record, target_package)]
 
     def search_package_from_repodata(self, target_package: SearchInfo,
-                                     get_week_version=False) -> list:
-        _candidate_list = []
-        _candidate_list_week_version = []
-        # grep with name
-        for arch in self.repodata.keys():
-            for package_key in self.repodata[arch]["packages.conda"].keys():
-                repodata_cl = PackageMetaInfo.from_repodata(package_key,
-                                                            self.repodata[arch]['packages.conda'][package_key])
-                # 名前が一致していなかったらcontinue
-                if target_package.name != repodata_cl.name:
-                    continue
-
-                # 名前は一致，バージョンをチェックして一致しなかったらcontinue
-                if target_package.version:
-                    print(' \n ')
-                    debug_print('target_package: ', target_package)
-                    debug_print('repodata_cl: ', repodata_cl)
-                    if not self._satisfies_version(repodata_cl.version, target_package.version):
-                        # check week version
-                        if get_week_version:
-                            pass
-                            # debug_print('get_week_version target_package: ', target_package)
-                            # debug_print('get_week_version repodata_cl: ', repodata_cl)
-                            # for version in target_package.version:
-                            #     m = re.match(r"(<=|>=|=|!=|<|>)(.+)", version.strip())
-                            #     op, ver = m.groups()
-                            #     if ver in repodata_cl.version:
-                            #         _candidate_list_week_version.append(repodata_cl)
-                        continue
-                # 名前とバージョンが一致，ビルドも一致したら特定のパッケージなのでreturn
-                if target_package.build:
-                    if self._satisfies_build(repodata_cl.build, target_package.build):
-                        return repodata_cl
-
-                # どれかしらに部分一致していたら代入
-                _candidate_list.append(repodata_cl)
-
-        # パッケージが見つからなかったら
-        if len(_candidate_list) == 0:
-            if get_week_version:
-                debug_print(_candidate_list_week_version)
-                _candidate_list = _candidate_list_week_version
-            else:
-                debug_print("return with no package")
-                return None
-
-            
-        if len(_candidate_list) > 0:
-            print(f'候補はまだたくさんあります．{len(_candidate_list)}')
-
-            # grep with max version
-            version_list = [c.version for c in _candidate_list]
-            max_version = max(version_list, key=LooseVersion)
-            _candidate_list = [c for c in _candidate_list if c.version == max_version]
-            print(f'最大値のバージョンで絞りました．候補はまだ {len(_candidate_list)} 個あります．')
-
-            # grep with build number
-            build_number_list = [int(c.build_number) for c in _candidate_list]
-            max_build_number = max(build_number_list)
-            _candidate_list = [c for c in _candidate_list if c.build_number == max_build_number]
-            print(f'build numberのバージョンで絞りました．候補はまだ {len(_candidate_list)} 個あります．')
-
-        # debug_print("_candidate_list: ", _candidate_list)
-        return _candidate_list[0]
+                                     get_week_version=False):
+        """
+        target_package に合うもののうち，バージョン・build_number・timestamp が最大のものを返す
+        レコードは並べてあるので，範囲の上から見て最初に合ったものが答え．見つからなければ None
+        """
+        records = self._get_records(target_package.name)
+        lo, hi = self._version_range(target_package.name, target_package.version)
+        for i in range(hi - 1, lo - 1, -1):
+            if self._matches(records[i], target_package):
+                return records[i]
+
+        debug_print("return with no package")
+        return None
+
+
+VIRTUAL_PACKAGES = frozenset(["__cuda", "__osx", "__glibc", "__linux", "__unix", "__win", "__conda"])
+
+def normalize_spec(spec: str) -> str:
+    # "python  >=3.10" と "python >=3.10" を同じものとして扱う
+    return " ".join(spec.split())
+
+def resolve(repodata: RepoData, specs: list, get_week_version=True) -> list:
+    """
+    specs（依存文字列のリスト）から依存関係をたどって，インストールする PackageMetaInfo のリストを返す
+    キューは deque，一度見た spec は seen に入れて二度と積まない
+    名前ごとに，それまでに出てきた spec のバージョン範囲の共通部分 (allowed) を持っておき，
+    探すときはその範囲で探す．名前ごとに最初に選んだパッケージを使い，同じ名前の spec はもう探さない
+    見つからないパッケージ・allowed に入るものが無い名前・選んだパッケージが後の spec を満たさないときは ValueError
+    """
+    queue = deque()
+    seen = set()
+    allowed = {}
+    name_specs = {}
+    resolved = {}
+
+    def _push(spec):
+        target_package = SearchInfo.from_depend_format(spec)
+        _range = _conditions_range(target_package.version)
+        if _range is not None:
+            allowed[target_package.name] = allowed.get(target_package.name, ANY_VERSION) & _range
+        name_specs.setdefault(target_package.name, []).append(spec)
+        seen.add(spec)
+        queue.append(spec)
+
+    for spec in specs:
+        _push(normalize_spec(spec))
+
+    while queue:
+        package = queue.popleft()
+        target_package = SearchInfo.from_depend_format(package)
+
+        installed = resolved.get(target_package.name)
+        if installed is not None:
+            if not repodata._matches(installed, target_package):
+                raise ValueError(f"version conflict: {installed.name} {installed.version} {installed.build} "
+                                 f"does not satisfy {package}")
+            continue
+
+        print('------------')
+        print("search: ", package)
+
+        # 今までの spec を全部満たすもの
+        narrowed = target_package._replace(version=VersionInfo(range=allowed.get(target_package.name, ANY_VERSION)))
+        install_target = repodata.search_package_from_repodata(narrowed, get_week_version=get_week_version)
+        if not install_target:
+            if repodata.search_package_from_repodata(target_package, get_week_version=get_week_version):
+                raise ValueError(f"version conflict: no {target_package.name} satisfies all of "
+                                 f"{', '.join(name_specs[target_package.name])}")
+            raise ValueError(f"no package are found: {package}")
+        resolved[target_package.name] = install_target
+        repodata.prefetch([d.split(' ')[0] for d in install_target.depends])
+
+        # 依存関係処理
+        for d in install_target.depends:
+            d = normalize_spec(d)
+            # check vertial package are in depends
+            if d.split(' ')[0] in VIRTUAL_PACKAGES or d in seen:
+                continue
+            _push(d)
+
+    return list(resolved.values())
+
+
+def check_consistency(repodata: RepoData, specs: list, result: list):
+    """
+    result (PackageMetaInfo のリスト) が specs と，その中のパッケージの depends / constrains を全部満たすか確かめる
+    同じ名前が 2 つある・入っていない依存がある・条件に合わないものがあれば ValueError
+    """
+    by_name = {}
+    for p in result:
+        if p.name in by_name:
+            raise ValueError(f"inconsistent result: {p.name} appears twice")
+        by_name[p.name] = p
+
+    def _check(spec, required, owner):
+        target_package = SearchInfo.from_depend_format(normalize_spec(spec))
+        if target_package.name in VIRTUAL_PACKAGES:
+            return
+        installed = by_name.get(target_package.name)
+        if installed is None:
+            if required:
+                raise ValueError(f"inconsistent result: {spec} (from {owner}) is missing")
+            return
+        if not repodata._matches(installed, target_package):
+            raise ValueError(f"inconsistent result: {installed.name} {installed.version} {installed.build} "
+                             f"does not satisfy {spec} (from {owner})")
+
+    for spec in specs:
+        _check(spec, True, "specs")
+    for p in result:
+        for d in p.depends:
+            _check(d, True, p.package_name)
+        for c in getattr(p, "constrains", None) or ():
+            _check(c, False, p.package_name)
+
+
+def cached_resolve(repodata: RepoData, specs: list, cache: SolveCache = None, resolver=resolve, **options) -> list:
+    """
+    同じ spec・subdir・repodata で前に解いた結果があればそれを返し，無ければ resolver で解いて保存する
+    options はそのまま resolver に渡し，key にも入れる (get_week_version など結果が変わるもの)
+    resolver が order_independent でなければ (resolve は spec の順番で結果が変わる) spec の順番も key に入れる
+    解いた結果は check_consistency で確かめてから保存する (合わなければ ValueError で，保存しない)
+    repodata が変われば content_hash が変わるので古い結果は使われない (そのうち LRU で消える)
+    """
+    if cache is None:
+        cache = SolveCache(os.path.join('.cache', 'solve'))
+    specs = [normalize_spec(spec) for spec in specs]
+    key = solve_key(specs, repodata.subdirs, repodata.content_hash,
+                    ordered=not getattr(resolver, "order_independent", False),
+                    resolver=f"{resolver.__module__}.{resolver.__qualname__}", **options)
+
+    entries = cache.get(key)
+    if entries is not None:
+        print(f"solve cache hit: {key[:16]}")
+        return [PackageMetaInfo.from_row(row, channel) for row, channel in entries]
+
+    result = resolver(repodata, specs, **options)
+    check_consistency(repodata, specs, result)
+    cache.put(key, [(tuple(getattr(p, field) for field in RECORD_FIELDS), p.channel) for p in result])
+    return result
 
 
 if __name__ == "__main__":
@@ -376,45 +778,20 @@ if __name__ == "__main__":
     debug_print(f"{package_name} {versions}")
     
     repodata = RepoData()
+    # repodata = RepoData(channels=[base_conda_forge_donwload_url, base_anaconda_donwload_url])
 
     packages = [f"{package_name} {versions}"]
 
-    # parse command
-    all_install_target = []
-    while packages:
-        package = packages.pop(0)
+    try:
+        all_install_target = cached_resolve(repodata, packages)
+    except ValueError as e:
+        print(e)
+        sys.exit()
 
-        print('------------')
-        print("search: ", package)
-        pprint(packages)
-
-        target_package = SearchInfo.from_depend_format(package)
-
-        if target_package.name in all_install_target:
-            print('already searche  d')
-        
-        debug_print("target_package: ", target_package)
-
-        install_target = repodata.search_package_from_repodata(target_package, get_week_version=True)
-        all_install_target.append(install_target)
-        
-        if not install_target:
-            print('no package are found')
-            sys.exit()
-
-        # 依存関係処理
-        for d in install_target.depends:
-
-            # check vertial package are in depends
-            virtual_package = ["__cuda", "__osx", "__glibc", "__linux", "__unix", "__win", "__conda"]
-            if d.split(' ')[0] in virtual_package:
-                continue
-
-            packages.append(d)
+    pprint(all_install_target)
 
-        packages = list(set(packages))
-        
+    # .prefix には変わったパッケージだけを入れ直す
+    install_targets(all_install_target)
 
-        # select depnds package
-    pprint(all_install_target)
+    print(time.time() - start_time)
 
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import json
+import tempfile
+import threading
+import contextlib
+from functools import partial
+from http.server import ThreadingHTTPServer
+from check_repodata_fetch import ChannelHandler
+from check_repodata_v3 import RepoData, cached_resolve
+from check_solver import PACKAGES, package, versions
+from solver import solve, LOWEST
+from solve_cache import SolveCache
+
+# ローカルの HTTP サーバをチャンネルにして，解いた結果のキャッシュが効くか・repodata が変われば外れるかを確認する
+
+
+def write_channel(channel_dir: str, packages: dict):
+    for subdir, subdir_packages in (("linux-64", packages), ("noarch", {})):
+        os.makedirs(os.path.join(channel_dir, subdir), exist_ok=True)
+        with open(os.path.join(channel_dir, subdir, "repodata.json"), mode="w") as f:
+            json.dump({"info": {"subdir": subdir}, "packages": {}, "packages.conda": subdir_packages}, f)
+
+
+if __name__ == "__main__":
+    channel_dir = tempfile.mkdtemp()
+    work_dir = tempfile.mkdtemp()
+    cache = SolveCache(tempfile.mkdtemp())
+    write_channel(channel_dir, PACKAGES)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), partial(ChannelHandler, directory=channel_dir))
+    server.requests_log = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    channel = f"http://127.0.0.1:{server.server_port}/"
+
+    calls = []
+
+    def counting_solve(repodata, specs, **options):
+        calls.append(specs)
+        return solve(repodata, specs, **options)
+    counting_solve.order_independent = True
+
+    # 1. 初回は解いて保存，2 回目 (spec の順番・書き方違い) は解かずに同じ結果を返す
+    repodata = RepoData(path=work_dir, channels=[channel])
+    first = cached_resolve(repodata, ["numpy", "python >=3.12"], cache, resolver=counting_solve)
+    second = cached_resolve(RepoData(path=work_dir, channels=[channel]), ["python  >=3.12", "numpy", "numpy"], cache,
+                            resolver=counting_solve)
+    assert len(calls) == 1
+    assert [(p.package_name, p.channel, p.depends, p.sha256) for p in first] == \
+           [(p.package_name, p.channel, p.depends, p.sha256) for p in second]
+    print("hit:", versions(second))
+
+    # 2. 結果が変わる設定は key に入る
+    lowest = cached_resolve(repodata, ["numpy", "python >=3.12"], cache, resolver=counting_solve, strategy=LOWEST)
+    assert len(calls) == 2 and versions(lowest)["numpy"] == "2.2.6"
+
+    # 3. repodata が変われば (python_abi 3.14 が増えて numpy 2.3.1 py314 が入れられる) 解き直す
+    write_channel(channel_dir, dict(PACKAGES, **dict([package("python_abi", "3.14", "8_cp314")])))
+    repodata = RepoData(path=work_dir, channels=[channel])
+    third = cached_resolve(repodata, ["numpy", "python >=3.12"], cache, resolver=counting_solve)
+    assert len(calls) == 3 and versions(third)["python"] == "3.14.0"
+    print("invalidated:", versions(third))
+
+    # 4. 合計サイズが上限を超えたら最後に使ったのが古いものから消す
+    small = SolveCache(tempfile.mkdtemp())
+
+    def cache_size():
+        return sum(os.path.getsize(os.path.join(small.cache_dir, name)) for name in os.listdir(small.cache_dir))
+
+    cached_resolve(repodata, ["numpy"], small, resolver=counting_solve)
+    cached_resolve(repodata, ["python"], small, resolver=counting_solve)
+    cached_resolve(repodata, ["numpy"], small, resolver=counting_solve)  # numpy のほうが後に使われた
+    small.max_bytes = cache_size()
+    cached_resolve(repodata, ["libzlib"], small, resolver=counting_solve)  # python が消える
+    assert cache_size() <= small.max_bytes
+    n_calls = len(calls)
+    cached_resolve(repodata, ["numpy"], small, resolver=counting_solve)
+    assert len(calls) == n_calls
+    cached_resolve(repodata, ["python"], small, resolver=counting_solve)
+    assert len(calls) == n_calls + 1
+    print("evicted:", len(os.listdir(small.cache_dir)), "entries kept")
+
+    # 5. resolve (貪欲) は spec の順番で結果が変わるので，順番が違えば別の key で解き直す
+    #    a, c: a 2.0 が c 1.* を積んでから c を探すので解ける / c, a: 先に c 2.0 を選んでしまい a 2.0 と矛盾する
+    write_channel(os.path.join(channel_dir, "order"), dict([
+        package("a", "1.0"), package("a", "2.0", depends=["c 1.*"]), package("c", "1.0"), package("c", "2.0"),
+    ]))
+    order = RepoData(path=tempfile.mkdtemp(), channels=[channel + "order/"])
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = cached_resolve(order, ["a", "c"], cache)
+    assert versions(result) == {"a": "2.0", "c": "1.0"}
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            cached_resolve(order, ["c", "a"], cache)
+        assert False
+    except ValueError as e:
+        print("order dependent:", e)
+
+    # 6. 依存の抜けた (矛盾した) 結果は保存しない
+    def broken_solve(repodata, specs, **options):
+        return [p for p in solve(repodata, specs, **options) if p.name != "python_abi"]
+    broken_solve.order_independent = True
+
+    empty = SolveCache(tempfile.mkdtemp())
+    try:
+        cached_resolve(repodata, ["numpy"], empty, resolver=broken_solve)
+        assert False
+    except ValueError as e:
+        print("not cached:", e)
+    assert os.listdir(empty.cache_dir) == []
+
+    server.shutdown()
+    print("ok")
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import json
+import tempfile
+import threading
+import contextlib
+from functools import partial
+from http.server import ThreadingHTTPServer
+from check_repodata_fetch import ChannelHandler
+from check_repodata_v3 import RepoData, resolve
+from solver import Solver, UnsatisfiableError, HIGHEST, LOWEST, LOWEST_DIRECT
+
+# ローカルのチャンネルで solver を確認する
+# python 3.14 はあるが python_abi 3.14 が無いので，貪欲に一番新しいものを選ぶ resolve は失敗する
+
+
+def package(name, version, build="h0000000_0", build_number=0, depends=(), constrains=None):
+    info = {"name": name, "version": version, "build": build, "build_number": build_number,
+            "depends": list(depends), "subdir": "linux-64"}
+    if constrains:
+        info["constrains"] = constrains
+    return f"{name}-{version}-{build}.conda", info
+
+
+PACKAGES = dict([
+    package("python", "3.12.11", "h0_cpython", depends=["python_abi 3.12.* *_cp312", "libzlib >=1.3"]),
+    package("python", "3.13.5", "h0_cpython", depends=["python_abi 3.13.* *_cp313", "libzlib >=1.3"]),
+    package("python", "3.14.0", "h0_cpython", depends=["python_abi 3.14.* *_cp314", "libzlib >=1.3"]),
+    package("python_abi", "3.12", "8_cp312"),
+    package("python_abi", "3.13", "8_cp313"),
+    package("libzlib", "1.2.13", "h0_0"),
+    package("libzlib", "1.3.1", "h0_1", build_number=1),
+    package("libzlib", "1.3.1", "h0_2", build_number=2),
+    package("numpy", "2.2.6", "py312h0_0", depends=["python >=3.12,<3.13.0a0", "python_abi 3.12.* *_cp312"]),
+    package("numpy", "2.2.6", "py313h0_0", depends=["python >=3.13,<3.14.0a0", "python_abi 3.13.* *_cp313"]),
+    package("numpy", "2.3.1", "py313h0_0", depends=["python >=3.13,<3.14.0a0", "python_abi 3.13.* *_cp313"]),
+    package("numpy", "2.3.1", "py314h0_1", build_number=1, depends=["python >=3.14,<3.15.0a0", "python_abi 3.14.* *_cp314"]),
+    package("scipy", "1.16.0", "py312h0_0", depends=["numpy >=1.25", "python >=3.12,<3.13.0a0"]),
+    package("pandas", "2.3.0", "py313h0_0", depends=["numpy >=1.26", "python >=3.13,<3.14.0a0"],
+            constrains=["scipy >=1.17"]),
+])
+
+
+def versions(result):
+    return {p.name: p.version for p in result}
+
+
+if __name__ == "__main__":
+    channel_dir = tempfile.mkdtemp()
+    work_dir = tempfile.mkdtemp()
+    for subdir, packages in (("linux-64", PACKAGES), ("noarch", {})):
+        os.makedirs(os.path.join(channel_dir, subdir))
+        with open(os.path.join(channel_dir, subdir, "repodata.json"), mode="w") as f:
+            json.dump({"info": {"subdir": subdir}, "packages": {}, "packages.conda": packages}, f)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), partial(ChannelHandler, directory=channel_dir))
+    server.requests_log = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    repodata = RepoData(path=work_dir, channels=[f"http://127.0.0.1:{server.server_port}/"])
+
+    # 1. 貪欲だと numpy 2.3.1 (py314) -> python 3.14 -> python_abi 3.14 が無くて失敗する
+    with contextlib.redirect_stdout(io.StringIO()):
+        try:
+            resolve(repodata, ["numpy"])
+            assert False
+        except ValueError:
+            pass
+    # 貪欲でも，選んだものが後の spec と合わなければ黙って返さずに ValueError
+    for specs in (["numpy 2.3.1 py313*", "python <3.13"], ["python <3.13", "numpy 2.3.1 py313*"], ["python_abi 3.12", "numpy 2.3.1"]):
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                resolve(repodata, specs)
+            assert False
+        except ValueError as e:
+            print("greedy conflict:", e)
+    result = Solver(repodata, HIGHEST).solve(["numpy"])
+    assert versions(result) == {"numpy": "2.3.1", "python": "3.13.5", "python_abi": "3.13", "libzlib": "1.3.1"}
+    assert [p.build_number for p in result if p.name == "libzlib"] == [2]
+    print("highest:", versions(result))
+
+    # 2. lowest は全部古いもの，lowest-direct は直接指定したものだけ古いもの
+    result = Solver(repodata, LOWEST).solve(["numpy"])
+    assert versions(result) == {"numpy": "2.2.6", "python": "3.12.11", "python_abi": "3.12", "libzlib": "1.3.1"}
+    print("lowest:", versions(result))
+    result = Solver(repodata, LOWEST_DIRECT).solve(["numpy", "python >=3.13"])
+    assert versions(result)["numpy"] == "2.2.6" and versions(result)["python"] == "3.13.5"
+    print("lowest-direct:", versions(result))
+
+    # 3. 依存同士の食い違いは学習した節で戻ってやり直す (scipy は python 3.12 だけ)
+    result = Solver(repodata, HIGHEST).solve(["numpy", "scipy"])
+    assert versions(result)["numpy"] == "2.2.6" and versions(result)["python"] == "3.12.11"
+    print("numpy + scipy:", versions(result))
+
+    # 4. 解が無いものと constrains
+    for specs in (["python >=3.14"], ["pandas", "scipy"], ["numpy >=3"]):
+        try:
+            Solver(repodata, HIGHEST).solve(specs)
+            assert False
+        except UnsatisfiableError as e:
+            print("unsatisfiable:", e)
+
+    # 5. 依存の節を作っている途中で矛盾しても，戻ったあとに残りの依存 (c) が抜けない
+    #    b 2.0 を選ぶ -> a 2.0 (b <2) と矛盾 -> b 1.0 に戻って a 2.0 を選び直す
+    repro_packages = dict([
+        package("b", "1.0"),
+        package("b", "2.0"),
+        package("a", "1.0", depends=["b >=3"]),
+        package("a", "2.0", depends=["b <2", "c"]),
+        package("c", "1.0"),
+    ])
+    for subdir, packages in (("linux-64", repro_packages), ("noarch", {})):
+        os.makedirs(os.path.join(channel_dir, "repro", subdir))
+        with open(os.path.join(channel_dir, "repro", subdir, "repodata.json"), mode="w") as f:
+            json.dump({"info": {"subdir": subdir}, "packages": {}, "packages.conda": packages}, f)
+    repro = RepoData(path=tempfile.mkdtemp(), channels=[f"http://127.0.0.1:{server.server_port}/repro/"])
+    result = Solver(repro, HIGHEST).solve(["b", "a"])
+    assert versions(result) == {"a": "2.0", "b": "1.0", "c": "1.0"}, versions(result)
+    print("b + a:", versions(result))
+
+    server.shutdown()
+    print("ok")
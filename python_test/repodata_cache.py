@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import json
+import marshal
+import re
+import mmap
+import struct
+import threading
+from array import array
+
+# repodata_<subdir>.json から作るバイナリキャッシュ
+#   header : b"MPMREPO<format version> <source fingerprint (固定幅)>\n"
+#   8 byte : 名前テーブルの offset (little endian)
+#   blobs  : 名前ごとに marshal した [row, ...]
+#   table  : marshal した {name: (offset, length)}
+# mmap して名前テーブルだけ読み，各 blob は初めて引かれたときに decode する
+# キャッシュが無い・古いときは json 自体を mmap してレコードのバイト範囲だけを拾い (RawNameIndex)，
+# キャッシュはバックグラウンドで作る
+CACHE_MAGIC = b"MPMREPO"
+CACHE_FORMAT_VERSION = 3
+# 差分を当てたときにヘッダを書き換えられるように，fingerprint は固定幅にする
+_FINGERPRINT_WIDTH = 48
+_TABLE_OFFSET = struct.Struct("<Q")
+_SEPARATOR = re.compile(rb"[\s,]*")
+_NAME_FIELD = re.compile(rb'"name"\s*:\s*"([^"\\]*)"')
+
+# 1 レコード = RECORD_FIELDS 順の tuple (row)
+# extra は license / track_features / constrains など残りのキーを marshal した bytes (無ければ None)
+RECORD_FIELDS = ("package_name", "name", "version", "build", "build_number", "depends",
+                 "subdir", "timestamp", "md5", "sha256", "size", "extra")
+_INFO_FIELDS = RECORD_FIELDS[1:-1]
+
+
+def source_fingerprint(json_path: str) -> str:
+    """
+    元の repodata json が変わったかどうかを判定するための値（サイズと mtime）
+    """
+    st = os.stat(json_path)
+    return f"{st.st_size}-{st.st_mtime_ns}"
+
+
+def default_cache_path(json_path: str) -> str:
+    # repodata_<subdir>.json -> repodata_<subdir>.cache
+    return os.path.splitext(json_path)[0] + ".cache"
+
+
+def record_row(package_key: str, info: dict) -> tuple:
+    """
+    repodata の 1 レコード (dict) を固定スキーマの row に詰める
+    """
+    extra = {key: value for key, value in info.items() if key not in _INFO_FIELDS}
+    # 何度も出てくる文字列は intern しておくと marshal が参照として書くので，decode 後も共有される
+    return (package_key, sys.intern(info["name"]), sys.intern(info["version"]), info.get("build"),
+            info.get("build_number"), tuple(sys.intern(d) for d in info.get("depends", ())),
+            sys.intern(info.get("subdir", "")), info.get("timestamp"), info.get("md5"),
+            info.get("sha256"), info.get("size"), marshal.dumps(extra) if extra else None)
+
+
+def build_name_index(repodata: dict) -> dict:
+    """
+    パッケージ名 -> [row, ...] の索引を作る
+    """
+    _index = {}
+    for package_key, info in repodata["packages.conda"].items():
+        _index.setdefault(info["name"], []).append(record_row(package_key, info))
+
+    return _index
+
+
+class CachedNameIndex:
+    """
+    mmap したキャッシュファイル上の索引．dict と同じように get / in で引ける
+    get するたびにその名前の blob を decode するので，結果は呼び出し側で保持すること
+    """
+    def __init__(self, mm: mmap.mmap, table: dict):
+        self._mm = mm
+        self._table = table
+
+    def __repr__(self):
+        return f"CachedNameIndex(names={len(self._table)})"
+
+    def __contains__(self, name):
+        return name in self._table
+
+    def __iter__(self):
+        return iter(self._table)
+
+    def __len__(self):
+        return len(self._table)
+
+    def get(self, name, default=None):
+        span = self._table.get(name)
+        if span is None:
+            return default
+        offset, length = span
+
+        return marshal.loads(self._mm[offset:offset + length])
+
+
+def scan_record_offsets(mm) -> dict:
+    """
+    repodata json の "packages.conda" の各レコードのバイト範囲を，json をパースせずに名前ごとに集める
+    {name: array('q', [offset, length, offset, length, ...])}  (範囲は '"key": {...}' の部分)
+    repodata のレコードは入れ子の無い object なので，文字列の外の最初の '}' で区切る
+    そうなっていないレコード (入れ子の object・"name" が無いなど) があれば，間違った範囲を返さずに ValueError
+    """
+    offsets = {}
+    find = mm.find
+    pos = find(b'"packages.conda"')
+    if pos < 0:
+        return offsets
+    pos = find(b'{', pos) + 1
+    size = len(mm)
+    while True:
+        # 次のキーか，"packages.conda" の終わりの '}'
+        pos = _SEPARATOR.match(mm, pos).end()
+        if pos >= size or mm[pos:pos + 1] != b'"':
+            if mm[pos:pos + 1] != b'}':
+                raise ValueError(f"Unexpected data in packages.conda at {pos}")
+            break
+        key_start = pos
+        start = find(b'{', find(b'"', key_start + 1))
+        if start < 0:
+            raise ValueError(f"Unterminated record in packages.conda at {key_start}")
+        end = find(b'}', start) + 1
+        record = mm[start:end]
+        # 文字列の中の '}' で切ってしまったら ('"' が奇数個) 次の '}' まで伸ばす
+        while end > start and (record.count(b'"') - record.count(b'\\"')) % 2:
+            end = find(b'}', end) + 1
+            record = mm[start:end]
+        if end <= start:
+            raise ValueError(f"Unterminated record in packages.conda at {key_start}")
+
+        match = _NAME_FIELD.search(record) if record.count(b'{') == 1 else None
+        if match is not None:
+            name = sys.intern(match.group(1).decode())
+        else:
+            # '{' が文字列の中にあるだけなら json として読める．入れ子の object で途中で切っていれば読めない
+            info = json.loads(record)
+            if not isinstance(info.get("name"), str):
+                raise ValueError(f"Record without name in packages.conda at {key_start}")
+            name = sys.intern(info["name"])
+        spans = offsets.get(name)
+        if spans is None:
+            spans = offsets[name] = array('q')
+        spans.append(key_start)
+        spans.append(end - key_start)
+        pos = end
+
+    return offsets
+
+
+class RawNameIndex:
+    """
+    mmap した repodata json 上の索引．CachedNameIndex と同じように get / in で引ける
+    get したときにその名前のレコードだけを json として decode する
+    """
+    def __init__(self, mm: mmap.mmap, offsets: dict):
+        self._mm = mm
+        self._offsets = offsets
+
+    def __repr__(self):
+        return f"RawNameIndex(names={len(self._offsets)})"
+
+    def __contains__(self, name):
+        return name in self._offsets
+
+    def __iter__(self):
+        return iter(self._offsets)
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def get(self, name, default=None):
+        spans = self._offsets.get(name)
+        if spans is None:
+            return default
+
+        # 同じ名前のレコードはまとめて 1 つの object として decode する
+        mm = self._mm
+        body = b",".join([mm[spans[i]:spans[i] + spans[i + 1]] for i in range(0, len(spans), 2)])
+        return [record_row(package_key, info) for package_key, info in json.loads(b"{" + body + b"}").items()]
+
+
+def open_raw_index(json_path: str):
+    """
+    json を mmap してレコードの範囲を拾った RawNameIndex を返す
+    範囲を拾えない形の json なら，全体を json.load して作った索引 (dict) を返す (get / in で引けるのは同じ)
+    """
+    with open(json_path, mode="rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    try:
+        offsets = scan_record_offsets(mm)
+    except ValueError:
+        mm.close()
+        with open(json_path, mode="rb") as f:
+            return build_name_index(json.load(f))
+
+    return RawNameIndex(mm, offsets)
+
+
+# load_name_index がバックグラウンドで書いているキャッシュ (update_cache はその間は触らない)
+_background_writes = {}
+_background_lock = threading.Lock()
+
+
+def _is_writing(cache_path: str) -> bool:
+    with _background_lock:
+        thread = _background_writes.get(os.path.abspath(cache_path))
+        if thread is not None and not thread.is_alive():
+            del _background_writes[os.path.abspath(cache_path)]
+            thread = None
+    return thread is not None
+
+
+def _cache_header(fingerprint: str) -> bytes:
+    return CACHE_MAGIC + f"{CACHE_FORMAT_VERSION} {fingerprint:<{_FINGERPRINT_WIDTH}}\n".encode()
+
+
+def write_cache(json_path: str, cache_path: str, raw_index: RawNameIndex = None):
+    """
+    名前ごとにレコードを decode して marshal し，キャッシュに書き出す
+    全部の dict を一度にメモリに載せないように，json は RawNameIndex で名前ずつ読む
+    """
+    fingerprint = source_fingerprint(json_path)
+    if raw_index is None:
+        raw_index = open_raw_index(json_path)
+
+    # 書きかけのファイルを読まないように一時ファイル経由で置き換える
+    tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, mode="wb") as f:
+        f.write(_cache_header(fingerprint))
+        table_offset_pos = f.tell()
+        f.write(_TABLE_OFFSET.pack(0))
+
+        table = {}
+        for name in raw_index:
+            blob = marshal.dumps(raw_index.get(name))
+            table[name] = (f.tell(), len(blob))
+            f.write(blob)
+
+        table_offset = f.tell()
+        marshal.dump(table, f)
+        f.seek(table_offset_pos)
+        f.write(_TABLE_OFFSET.pack(table_offset))
+    os.replace(tmp_path, cache_path)
+
+
+def read_cache(json_path: str, cache_path: str):
+    """
+    キャッシュが元の json と一致していれば CachedNameIndex を返す．古い・壊れているときは None
+    """
+    if not os.path.exists(cache_path):
+        return None
+
+    header = _cache_header(source_fingerprint(json_path))
+    with open(cache_path, mode="rb") as f:
+        if os.fstat(f.fileno()).st_size < len(header) + _TABLE_OFFSET.size:
+            return None
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if mm[:len(header)] != header:
+        mm.close()
+        return None
+
+    (table_offset,) = _TABLE_OFFSET.unpack_from(mm, len(header))
+    try:
+        table = marshal.loads(mm[table_offset:])
+    except (EOFError, ValueError, TypeError):
+        mm.close()
+        return None
+
+    return CachedNameIndex(mm, table)
+
+
+def _copy_range(src, dst, length: int, chunk_size: int = 1 << 20):
+    while length > 0:
+        data = src.read(min(chunk_size, length))
+        if not data:
+            raise EOFError("cache file is truncated")
+        dst.write(data)
+        length -= len(data)
+
+
+def update_cache(json_path: str, cache_path: str, old_fingerprint: str, rows_by_name: dict) -> bool:
+    """
+    json に差分を当てたあと，変わった名前の blob だけを足して名前テーブルを書き直したキャッシュに置き換える
+    rows_by_name: {name: [row, ...]}  (空のリストならその名前を消す)
+    変わらない名前の blob は同じ位置に写すだけで decode しない．write_cache と同じく一時ファイル経由で置き換えるので，
+    古いキャッシュを mmap しているものはそのまま読める
+    キャッシュが差分を当てる前の json (old_fingerprint) のものでない・バックグラウンドで書いている途中なら何もせず False
+    古い blob はそのまま残るので，ファイルの半分以上が使われなくなったら作り直す
+    """
+    if not os.path.exists(cache_path) or _is_writing(cache_path):
+        return False
+
+    old_header = _cache_header(old_fingerprint)
+    tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(cache_path, mode="rb") as src:
+            if src.read(len(old_header)) != old_header:
+                return False
+            (table_offset,) = _TABLE_OFFSET.unpack(src.read(_TABLE_OFFSET.size))
+            src.seek(table_offset)
+            table = marshal.load(src)
+
+            with open(tmp_path, mode="wb") as f:
+                # header は固定幅なので，古い blob は同じ offset のまま使える
+                f.write(_cache_header(source_fingerprint(json_path)))
+                table_offset_pos = f.tell()
+                f.write(_TABLE_OFFSET.pack(0))
+                src.seek(f.tell())
+                _copy_range(src, f, table_offset - f.tell())
+
+                for name, rows in rows_by_name.items():
+                    if not rows:
+                        table.pop(name, None)
+                        continue
+                    blob = marshal.dumps(rows)
+                    table[name] = (f.tell(), len(blob))
+                    f.write(blob)
+
+                table_offset = f.tell()
+                marshal.dump(table, f)
+                f.seek(table_offset_pos)
+                f.write(_TABLE_OFFSET.pack(table_offset))
+                size = f.seek(0, os.SEEK_END)
+        os.replace(tmp_path, cache_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    live_size = sum(length for _, length in table.values())
+    if size > 2 * live_size + (1 << 20):
+        write_cache(json_path, cache_path)
+    return True
+
+
+def load_name_index(json_path: str, cache_path: str = None, background: bool = True):
+    """
+    キャッシュがあればそれを開く (CachedNameIndex)
+    無い・古いときは json のレコードの位置だけを拾った RawNameIndex をすぐに返し，
+    キャッシュはスレッドで作る (background=False なら作り終わってからキャッシュを返す)
+    """
+    if cache_path is None:
+        cache_path = default_cache_path(json_path)
+
+    _index = read_cache(json_path, cache_path)
+    if _index is not None:
+        return _index
+
+    raw_index = open_raw_index(json_path)
+    if not background:
+        write_cache(json_path, cache_path, raw_index)
+        return read_cache(json_path, cache_path)
+
+    # daemon にしないので，プロセスはキャッシュを書き終えてから終わる
+    thread = threading.Thread(target=write_cache, args=(json_path, cache_path, raw_index),
+                              name=f"write_cache:{os.path.basename(cache_path)}")
+    with _background_lock:
+        _background_writes[os.path.abspath(cache_path)] = thread
+    thread.start()
+    return raw_index
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import hashlib
+import requests
+import zstandard as zstd
+
+CHUNK_SIZE = 1 << 16
+DEFAULT_CHANNEL_ALIAS = "https://conda.anaconda.org/"
+
+
+def channel_url(channel: str) -> str:
+    """
+    "conda-forge" のような名前だけのチャンネルは conda.anaconda.org の URL にする
+    """
+    if "://" not in channel:
+        channel = DEFAULT_CHANNEL_ALIAS + channel
+
+    return channel.rstrip("/") + "/"
+
+
+def channel_name(channel: str) -> str:
+    """
+    チャンネルごとのファイル (repodata json / state / キャッシュ / シャードの索引) の名前に使う
+    最後の部分だけだと別のホストの同じ名前のチャンネルとぶつかるので，URL 全体の hash を付ける
+    "https://repo.anaconda.com/pkgs/main/" -> "main-<URL の sha256 の先頭 8 文字>"
+    """
+    url = channel_url(channel)
+    return f"{url.rstrip('/').rsplit('/', 1)[-1]}-{hashlib.sha256(url.encode()).hexdigest()[:8]}"
+
+
+def make_session(pool_size: int = 10) -> requests.Session:
+    """
+    スレッド間で共有する Session．コネクションプールをスレッド数に合わせて広げておく
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    return session
+
+
+def _state_path(json_path: str) -> str:
+    # ETag / Last-Modified などを保存しておくサイドカーファイル
+    return json_path + ".state.json"
+
+
+def load_fetch_state(json_path: str) -> dict:
+    if not os.path.exists(json_path) or not os.path.exists(_state_path(json_path)):
+        return {}
+    try:
+        with open(_state_path(json_path), mode="r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_fetch_state(json_path: str, state: dict):
+    tmp_path = _state_path(json_path) + ".tmp"
+    with open(tmp_path, mode="w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, _state_path(json_path))
+
+
+def _conditional_headers(state: dict, url: str) -> dict:
+    # 保存してある検証子は同じ URL から取ったものだけ使える
+    headers = {}
+    if state.get("url") != url:
+        return headers
+    if state.get("etag"):
+        headers["If-None-Match"] = state["etag"]
+    if state.get("last_modified"):
+        headers["If-Modified-Since"] = state["last_modified"]
+
+    return headers
+
+
+def _stream_to_file(response, json_path: str, decompress: bool) -> str:
+    """
+    受け取ったチャンクをそのまま（.zst なら展開しながら）一時ファイルに書き，最後に置き換える
+    途中で失敗しても既存の json は壊れない
+    書いた中身の blake2b-256 (jlap の "from" / "to" と同じもの) を返す
+    """
+    tmp_path = json_path + ".part"
+    hasher = hashlib.blake2b(digest_size=32)
+    try:
+        with open(tmp_path, mode="wb") as f:
+            dobj = zstd.ZstdDecompressor().decompressobj() if decompress else None
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                data = dobj.decompress(chunk) if dobj else chunk
+                hasher.update(data)
+                f.write(data)
+        os.replace(tmp_path, json_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    return hasher.hexdigest()
+
+
+def fetch_repodata(url: str, json_path: str, session=None) -> bool:
+    """
+    url (.../repodata.json) を json_path にストリーミングで保存する
+    repodata.json.zst があればそちらを優先し，ETag / Last-Modified で再検証する
+    更新があれば True，304 Not Modified やオフラインで既存ファイルを使うときは False
+    サーバの 5xx は繋がらないのと同じ扱いで，次の URL を試し，どれもだめなら既存ファイルを使う
+    """
+    session = session or requests.Session()
+    state = load_fetch_state(json_path)
+
+    # .zst が無いと分かるのは 404 のときだけ (5xx で .json に回っても次回はまた .zst を試す)
+    has_zst = state.get("has_zst") is not False
+    candidates = [(url + ".zst", True), (url, False)]
+    if not has_zst:
+        candidates = candidates[1:]
+
+    error = None
+    for fetch_url, is_zst in candidates:
+        try:
+            response = session.get(fetch_url, headers=_conditional_headers(state, fetch_url),
+                                    stream=True, timeout=60)
+        except (requests.ConnectionError, requests.Timeout):
+            if os.path.exists(json_path):
+                return False
+            raise
+
+        with response:
+            if response.status_code == 304:
+                return False
+            if is_zst and response.status_code == 404:
+                has_zst = False
+                continue
+            try:
+                response.raise_for_status()
+            except requests.HTTPError as e:
+                if response.status_code < 500:
+                    raise
+                error = e
+                continue
+
+            blake2_256 = _stream_to_file(response, json_path, decompress=is_zst)
+
+        _save_fetch_state(json_path, {
+            "url": fetch_url,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "has_zst": has_zst,
+            "blake2_256": blake2_256,
+        })
+        return True
+
+    if os.path.exists(json_path):
+        return False
+    raise error
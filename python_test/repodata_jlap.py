@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import hashlib
+import requests
+from repodata_cache import default_cache_path, record_row, source_fingerprint, update_cache
+from repodata_fetch import fetch_repodata, load_fetch_state, _save_fetch_state
+
+# repodata.jlap による差分更新
+#   1 行目     : iv (32 byte の hex)
+#   途中の行   : {"from": <hash>, "to": <hash>, "patch": [RFC 6902 の JSON patch]}
+#   最後から 2 : {"url": "repodata.json", "latest": <hash>}
+#   最後の行   : ここまでの鎖の hash (hex)
+# 各行の hash は blake2b-256(行, key=1 つ前の行の hash)．"from" / "to" は repodata.json の blake2b-256
+# 手元の repodata.json の hash から "latest" まで patch を順に当てる
+JLAP_DIGEST_SIZE = 32
+
+
+def _line_hash(line: bytes, key: bytes) -> bytes:
+    return hashlib.blake2b(line, key=key, digest_size=JLAP_DIGEST_SIZE).digest()
+
+
+def parse_jlap(body: bytes, iv: bytes = None):
+    """
+    jlap を行ごとに分けて hash の鎖を確かめる
+    iv が無ければ body は 1 行目 (iv) から，あれば body は前回の続き (patch の行から)
+    (patches, footer, 最後の patch 行までの hash, footer の行が始まる body 内の位置) を返す．鎖が合わなければ ValueError
+    """
+    lines = body.split(b"\n")
+    if lines and lines[-1] == b"":
+        lines.pop()
+    offset = 0
+    if iv is None:
+        iv = bytes.fromhex(lines[0].decode())
+        offset = len(lines[0]) + 1
+        lines = lines[1:]
+    if len(lines) < 2:
+        raise ValueError("jlap is too short")
+
+    patch_lines, footer_line, checksum = lines[:-2], lines[-2], lines[-1]
+    patches = []
+    for line in patch_lines:
+        iv = _line_hash(line, iv)
+        patches.append(json.loads(line))
+        offset += len(line) + 1
+    if _line_hash(footer_line, iv).hex() != checksum.decode().strip():
+        raise ValueError("jlap checksum mismatch")
+
+    return patches, json.loads(footer_line), iv, offset
+
+
+# ---------- JSON patch (RFC 6902) ----------
+
+def _pointer(path: str) -> list:
+    if path == "":
+        return []
+    if not path.startswith("/"):
+        raise ValueError(f"Invalid JSON pointer: {path}")
+    return [token.replace("~1", "/").replace("~0", "~") for token in path[1:].split("/")]
+
+
+def _parent(doc, tokens: list):
+    for token in tokens[:-1]:
+        doc = doc[int(token)] if isinstance(doc, list) else doc[token]
+    return doc
+
+
+def _get(doc, tokens: list):
+    for token in tokens:
+        doc = doc[int(token)] if isinstance(doc, list) else doc[token]
+    return doc
+
+
+def _add(doc, tokens: list, value):
+    if not tokens:
+        return value
+    parent = _parent(doc, tokens)
+    if isinstance(parent, list):
+        parent.insert(len(parent) if tokens[-1] == "-" else int(tokens[-1]), value)
+    else:
+        parent[tokens[-1]] = value
+    return doc
+
+
+def _remove(doc, tokens: list):
+    parent = _parent(doc, tokens)
+    if isinstance(parent, list):
+        return parent.pop(int(tokens[-1]))
+    return parent.pop(tokens[-1])
+
+
+def apply_patch(doc, patch: list):
+    """
+    RFC 6902 の JSON patch を doc にその場で当てる (ルートを置き換えたときのために doc を返す)
+    """
+    for operation in patch:
+        op = operation["op"]
+        tokens = _pointer(operation["path"])
+        if op == "add":
+            doc = _add(doc, tokens, operation["value"])
+        elif op == "remove":
+            _remove(doc, tokens)
+        elif op == "replace":
+            if not tokens:
+                doc = operation["value"]
+            else:
+                _get(doc, tokens)  # 無いものは置き換えられない
+                parent = _parent(doc, tokens)
+                parent[int(tokens[-1]) if isinstance(parent, list) else tokens[-1]] = operation["value"]
+        elif op == "move":
+            value = _remove(doc, _pointer(operation["from"]))
+            doc = _add(doc, tokens, value)
+        elif op == "copy":
+            doc = _add(doc, tokens, json.loads(json.dumps(_get(doc, _pointer(operation["from"])))))
+        elif op == "test":
+            if _get(doc, tokens) != operation["value"]:
+                raise ValueError(f"JSON patch test failed: {operation['path']}")
+        else:
+            raise ValueError(f"Invalid JSON patch operation: {op}")
+
+    return doc
+
+
+def _touched_keys(patch: list):
+    """
+    patch が触る packages.conda のキー．packages.conda ごと置き換えるなら None
+    """
+    keys = set()
+    for operation in patch:
+        for path in (operation["path"], operation.get("from")):
+            if path is None:
+                continue
+            tokens = _pointer(path)
+            if not tokens or (tokens[0] == "packages.conda" and len(tokens) == 1):
+                return None
+            if tokens[0] == "packages.conda":
+                keys.add(tokens[1])
+    return keys
+
+
+# ---------- 取ってきて当てる ----------
+
+def _jlap_url(url: str) -> str:
+    # .../repodata.json -> .../repodata.jlap
+    return url[:-len(".json")] + ".jlap"
+
+
+def _fetch_jlap(url: str, jlap_state: dict, session):
+    """
+    前回の続き (Range) から jlap を取る．サーバが Range に対応していなければ全部
+    (patches, footer, 次回の jlap_state) を返す．jlap が無ければ None
+    """
+    headers = {}
+    if jlap_state.get("pos"):
+        headers["Range"] = f"bytes={jlap_state['pos']}-"
+    response = session.get(url, headers=headers, timeout=60)
+    if response.status_code == 404:
+        return None
+    if response.status_code == 416:
+        # 前回から何も増えていない (footer ごと取り直す)
+        return _fetch_jlap(url, {}, session)
+    response.raise_for_status()
+
+    if response.status_code == 206:
+        try:
+            patches, footer, iv, offset = parse_jlap(response.content, bytes.fromhex(jlap_state["iv"]))
+            return patches, footer, {"pos": jlap_state["pos"] + offset, "iv": iv.hex()}
+        except ValueError:
+            # サーバ側で jlap が作り直された
+            return _fetch_jlap(url, {}, session)
+
+    patches, footer, iv, offset = parse_jlap(response.content)
+    return patches, footer, {"pos": offset, "iv": iv.hex()}
+
+
+def _rows_by_name(repodata: dict, names: set) -> dict:
+    rows = {name: [] for name in names}
+    for package_key, info in repodata.get("packages.conda", {}).items():
+        if info["name"] in rows:
+            rows[info["name"]].append(record_row(package_key, info))
+    return rows
+
+
+def fetch_repodata_jlap(url: str, json_path: str, session=None, cache_path: str = None) -> bool:
+    """
+    手元に repodata.json があれば repodata.jlap の差分を当てて最新にする
+    当てた packages.conda のキーの名前だけキャッシュ (cache_path，省略時は load_name_index と同じ場所) を更新する
+    jlap が無い・手元の hash から辿れない・壊れているときは fetch_repodata で全部取り直す
+    jlap を使わないと覚えるのは jlap が 404 のときだけ．5xx や壊れた jlap は今回だけ fetch_repodata にする
+    更新があれば True
+    """
+    session = session or requests.Session()
+    state = load_fetch_state(json_path)
+    have = state.get("blake2_256")
+    if not have or state.get("has_jlap") is False:
+        return fetch_repodata(url, json_path, session)
+
+    try:
+        fetched = _fetch_jlap(_jlap_url(url), state.get("jlap", {}), session)
+    except (requests.ConnectionError, requests.Timeout):
+        return False
+    except (requests.HTTPError, ValueError):
+        # 5xx や鎖が合わないのは一時的なものかもしれないので，今回だけ取り直して jlap は止めない
+        # (続きから取る位置は当てにならないので捨て，次回は jlap を頭から取る)
+        updated = fetch_repodata(url, json_path, session)
+        state = load_fetch_state(json_path)
+        if state.pop("jlap", None) is not None:
+            _save_fetch_state(json_path, state)
+        return updated
+    if fetched is None:
+        # jlap が無い (404) ときだけ，次回から jlap を試さない
+        updated = fetch_repodata(url, json_path, session)
+        state = load_fetch_state(json_path)
+        state["has_jlap"] = False
+        _save_fetch_state(json_path, state)
+        return updated
+    patches, footer, jlap_state = fetched
+
+    latest = footer["latest"]
+    if have == latest:
+        state["jlap"] = jlap_state
+        _save_fetch_state(json_path, state)
+        return False
+
+    # have から latest まで辿れる patch の列
+    by_from = {patch["from"]: patch for patch in patches}
+    chain = []
+    current = have
+    while current != latest:
+        patch = by_from.get(current)
+        if patch is None or len(chain) > len(patches):
+            # 手元が古すぎる (jlap に残っていない)
+            return fetch_repodata(url, json_path, session)
+        chain.append(patch)
+        current = patch["to"]
+
+    old_fingerprint = source_fingerprint(json_path)
+    with open(json_path, mode="r") as f:
+        repodata = json.load(f)
+
+    touched = set()
+    for patch in chain:
+        keys = _touched_keys(patch["patch"])
+        packages = repodata.get("packages.conda", {})
+        touched_names = None if keys is None else {packages[key]["name"] for key in keys if key in packages}
+        repodata = apply_patch(repodata, patch["patch"])
+        packages = repodata.get("packages.conda", {})
+        if keys is None or touched is None:
+            touched = None
+        else:
+            touched |= touched_names | {packages[key]["name"] for key in keys if key in packages}
+
+    tmp_path = json_path + ".part"
+    with open(tmp_path, mode="w") as f:
+        json.dump(repodata, f)
+    os.replace(tmp_path, json_path)
+    state.update({"blake2_256": latest, "jlap": jlap_state})
+    _save_fetch_state(json_path, state)
+
+    # 変わった名前だけ索引を作り直す (全体が変わったならキャッシュは次に開くときに作り直される)
+    if touched is not None:
+        update_cache(json_path, cache_path or default_cache_path(json_path), old_fingerprint, _rows_by_name(repodata, touched))
+    print(f"jlap: {len(chain)} patches, {'all' if touched is None else len(touched)} names re-indexed")
+
+    return True
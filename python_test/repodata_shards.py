@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+import os
+import hashlib
+import requests
+import zstandard as zstd
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+from urllib.parse import urljoin
+from concurrent.futures import ThreadPoolExecutor
+from repodata_cache import record_row
+from repodata_fetch import load_fetch_state, _save_fetch_state, _conditional_headers
+
+# CEP-16 の sharded repodata
+#   <channel>/<subdir>/repodata_shards.msgpack.zst : {"info": {"base_url", "shards_base_url", ...},
+#                                                     "shards": {name: sha256 (32 bytes)}}
+#   <shards_base_url>/<sha256 hex>.msgpack.zst     : {"packages": {...}, "packages.conda": {...}}
+# シャードは中身 (圧縮したファイル) の sha256 が名前なので，一度取ったものはそのまま使い回せる
+SHARD_INDEX_NAME = "repodata_shards.msgpack.zst"
+MAX_SHARD_WORKERS = 16
+
+
+def _unpack_zst(data: bytes):
+    return msgpack.unpackb(zstd.ZstdDecompressor().decompressobj().decompress(data), raw=False)
+
+
+def fetch_shard_index(url: str, path: str, session=None):
+    """
+    シャードの索引 (.../repodata_shards.msgpack.zst) を path に保存して decode したものを返す
+    ETag / Last-Modified で再検証する．チャンネルが sharded repodata に対応していなければ None
+    """
+    if msgpack is None:
+        return None
+    session = session or requests.Session()
+    state = load_fetch_state(path)
+
+    try:
+        response = session.get(url, headers=_conditional_headers(state, url), timeout=60)
+    except (requests.ConnectionError, requests.Timeout):
+        if not os.path.exists(path):
+            raise
+    else:
+        with response:
+            if response.status_code == 404:
+                return None
+            if response.status_code != 304:
+                response.raise_for_status()
+                tmp_path = path + ".part"
+                with open(tmp_path, mode="wb") as f:
+                    f.write(response.content)
+                os.replace(tmp_path, path)
+                _save_fetch_state(path, {
+                    "url": url,
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                })
+
+    with open(path, mode="rb") as f:
+        return _unpack_zst(f.read())
+
+
+def _shard_rows(shard: dict) -> list:
+    # シャードの sha256 / md5 は bytes なので repodata.json と同じ hex 文字列にする
+    rows = []
+    for package_key, info in shard.get("packages.conda", {}).items():
+        for key in ("sha256", "md5"):
+            if isinstance(info.get(key), bytes):
+                info[key] = info[key].hex()
+        rows.append(record_row(package_key, info))
+
+    return rows
+
+
+class ShardedNameIndex:
+    """
+    シャードの索引だけを持ち，名前を引かれたときにその名前のシャードを取ってくる
+    CachedNameIndex / RawNameIndex と同じように get / in で引ける
+    シャードは cache_dir/<sha256 hex>.msgpack.zst に保存し，次からはネットワークに行かない
+    """
+    def __init__(self, index_url: str, shard_index: dict, cache_dir: str, session=None):
+        info = shard_index.get("info", {})
+        self._shards_url = urljoin(index_url, info.get("shards_base_url") or "./shards/")
+        if not self._shards_url.endswith("/"):
+            self._shards_url += "/"
+        self._shards = shard_index["shards"]
+        self._cache_dir = cache_dir
+        self._session = session or requests.Session()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def __repr__(self):
+        return f"ShardedNameIndex(names={len(self._shards)})"
+
+    def __contains__(self, name):
+        return name in self._shards
+
+    def __iter__(self):
+        return iter(self._shards)
+
+    def __len__(self):
+        return len(self._shards)
+
+    def _shard_path(self, name: str) -> str:
+        return os.path.join(self._cache_dir, self._shards[name].hex() + ".msgpack.zst")
+
+    def _fetch_shard(self, name: str) -> bytes:
+        """
+        シャードをキャッシュから読む．無ければ取ってきて sha256 を確かめてから保存する
+        """
+        path = self._shard_path(name)
+        if os.path.exists(path):
+            with open(path, mode="rb") as f:
+                return f.read()
+
+        digest = self._shards[name].hex()
+        response = self._session.get(f"{self._shards_url}{digest}.msgpack.zst", timeout=60)
+        response.raise_for_status()
+        data = response.content
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise ValueError(f"sha256 mismatch for shard of {name}")
+
+        tmp_path = f"{path}.{os.getpid()}.part"
+        with open(tmp_path, mode="wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return data
+
+    def prefetch(self, names):
+        """
+        まだキャッシュに無いシャードをまとめて並行に取ってくる
+        """
+        missing = [name for name in set(names)
+                   if name in self._shards and not os.path.exists(self._shard_path(name))]
+        if len(missing) <= 1:
+            return
+        with ThreadPoolExecutor(max_workers=min(MAX_SHARD_WORKERS, len(missing))) as executor:
+            list(executor.map(self._fetch_shard, missing))
+
+    def get(self, name, default=None):
+        if name not in self._shards:
+            return default
+
+        return _shard_rows(_unpack_zst(self._fetch_shard(name)))
+
+
+def load_shard_index(channel: str, subdir: str, path: str, cache_dir: str, session=None):
+    """
+    channel/subdir の sharded repodata を開く．対応していない (msgpack が無い・索引が 404) ときは None
+    """
+    index_url = urljoin(channel, f"{subdir}/{SHARD_INDEX_NAME}")
+    shard_index = fetch_shard_index(index_url, path, session)
+    if shard_index is None:
+        return None
+
+    return ShardedNameIndex(index_url, shard_index, cache_dir, session)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import marshal
+import hashlib
+
+# 解いた結果 (PackageMetaInfo のリスト) のキャッシュ
+#   <cache_dir>/<key>.solve : marshal した [(row, channel), ...]  (row は repodata_cache の RECORD_FIELDS の順)
+# key は spec・subdir・チャンネル・repodata の中身の hash から作るので，repodata が変われば自然に外れる
+# ファイルの mtime を最後に使った時刻として，合計サイズが上限を超えたら古いものから消す (LRU)
+SOLVE_CACHE_MAX_BYTES = 64 << 20
+SOLVE_CACHE_SUFFIX = ".solve"
+
+
+def solve_key(specs: list, subdirs: list, repodata_hash: str, ordered: bool = False, **options) -> str:
+    """
+    spec の重複には依らない key を作る (spec は normalize_spec 済みのもの)
+    結果が spec の順番で変わる resolver なら ordered にして順番も key に入れる (そうでなければ順番には依らない)
+    options には結果が変わる設定 (戦略など) を入れる
+    """
+    specs = list(dict.fromkeys(specs)) if ordered else sorted(set(specs))
+    payload = json.dumps({"specs": specs, "ordered": ordered, "subdirs": list(subdirs),
+                          "repodata": repodata_hash, "options": options}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class SolveCache:
+    """
+    key -> [(row, channel), ...] をファイル 1 つずつに保存する．プロセスをまたいで使える
+    """
+    def __init__(self, cache_dir: str, max_bytes: int = SOLVE_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def __repr__(self):
+        return f"SolveCache(cache_dir={self.cache_dir!r}, max_bytes={self.max_bytes})"
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + SOLVE_CACHE_SUFFIX)
+
+    def get(self, key: str, default=None):
+        path = self._path(key)
+        try:
+            with open(path, mode="rb") as f:
+                entries = marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            return default
+        # 使ったので LRU の先頭に回す
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        return entries
+
+    def put(self, key: str, entries: list):
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.part"
+        with open(tmp_path, mode="wb") as f:
+            marshal.dump(entries, f)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        """
+        合計サイズが max_bytes 以下になるまで，最後に使ったのが古いものから消す
+        """
+        files = []
+        total = 0
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if not entry.name.endswith(SOLVE_CACHE_SUFFIX):
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                files.append((st.st_mtime_ns, st.st_size, entry.path))
+                total += st.st_size
+
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
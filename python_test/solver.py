@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+from pprint import pprint
+from check_repodata_v3 import RepoData, SearchInfo, VIRTUAL_PACKAGES, normalize_spec, record_key
+
+# search_package_from_repodata は spec ごとに最大のバージョンを貪欲に選ぶだけなので，
+# 後の依存が満たせないと (python=3.14 -> python_abi など) そこで失敗する
+# ここでは候補のパッケージ 1 つ 1 つを変数にした SAT として解く
+#   - spec: (候補1 or 候補2 or ...)            依存: (not pkg or 候補1 or 候補2 or ...)
+#   - 同じ名前のパッケージは 1 つだけ            constrains: (not pkg or not 条件に合わない候補)
+# 単位伝播 (two watched literals) と，矛盾したら 1UIP で節を学習して非時系列にバックジャンプする CDCL
+# 依存の節はそのパッケージが真になったときに初めて作る (resolvo と同じく遅延して展開する)
+
+# src/main.rs の SolveStrategy と同じ
+HIGHEST = "highest"              # 全部のパッケージで一番新しいバージョン
+LOWEST = "lowest"                # 全部のパッケージで一番古いバージョン
+LOWEST_DIRECT = "lowest-direct"  # 直接指定したパッケージだけ一番古いバージョン，依存は一番新しいバージョン
+STRATEGIES = (HIGHEST, LOWEST, LOWEST_DIRECT)
+
+
+class UnsatisfiableError(ValueError):
+    pass
+
+
+def _groups(candidates: list, key) -> list:
+    # record_key の昇順に並んだ候補を，key が同じものの塊に分ける (塊の中は元の順番のまま)
+    groups = []
+    for candidate in candidates:
+        if groups and key(candidate) == key(groups[-1][0]):
+            groups[-1].append(candidate)
+        else:
+            groups.append([candidate])
+    return groups
+
+
+def _highest_first(candidates: list) -> list:
+    """
+    record_key の昇順に並んだ候補を降順にする
+    record_key が同じもの同士は repodata の順番のまま (sorted(..., reverse=True) と同じ)
+    """
+    return [candidate for group in reversed(_groups(candidates, record_key)) for candidate in group]
+
+
+def _lowest_first(candidates: list) -> list:
+    """
+    record_key の昇順に並んだ候補を，バージョンは古い順・同じバージョンの中ではビルドの新しい順にする
+    (並べ直さずに同じバージョンの塊の中だけ _highest_first にする)
+    """
+    return [candidate for group in _groups(candidates, lambda record: record_key(record)[0])
+            for candidate in _highest_first(group)]
+
+
+class Solver():
+    def __init__(self, repodata: RepoData, strategy=HIGHEST):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Invalid strategy: {strategy}")
+        self.repodata = repodata
+        self.strategy = strategy
+
+        # 変数は 1 から．リテラルは変数番号の正負
+        self.records = [None]       # var -> PackageMetaInfo
+        self.value = [None]         # var -> True / False / None
+        self.level = [0]            # var -> 決定レベル
+        self.reason = [None]        # var -> 伝播したときの節 (決定なら None)
+        self.expanded = [False]     # var -> 依存の節を作ったかどうか
+        self.requirements = [None]  # var -> [候補のリスト (優先順)]
+        self.name_vars = {}         # name -> [var, ...]
+        self.spec_vars = {}         # spec -> [var, ...] (優先順)
+        self.var_names = [None]     # var -> name
+        self.uninstallable = set()  # 候補が 1 つも無い依存を持つ var (単位節は覚えておけないので)
+
+        self.clauses = []
+        self.watches = {}           # literal -> [節の番号]  (そのリテラルが偽になったら見る)
+        self.trail = []
+        self.trail_lim = []
+        self.qhead = 0
+
+    # ---------- 変数と節 ----------
+
+    def _vars_of_name(self, name: str) -> list:
+        _vars = self.name_vars.get(name)
+        if _vars is None:
+            _vars = []
+            for record in self.repodata._get_records(name):
+                self.records.append(record)
+                self.value.append(None)
+                self.level.append(0)
+                self.reason.append(None)
+                self.expanded.append(False)
+                self.requirements.append(None)
+                self.var_names.append(name)
+                _vars.append(len(self.records) - 1)
+            self.name_vars[name] = _vars
+        return _vars
+
+    def _vars_of_spec(self, spec: str) -> list:
+        """
+        spec に合う候補の変数を，strategy の優先順に並べて返す
+        """
+        _vars = self.spec_vars.get(spec)
+        if _vars is None:
+            target_package = SearchInfo.from_depend_format(spec)
+            var_of_record = {id(self.records[v]): v for v in self._vars_of_name(target_package.name)}
+            candidates = self.repodata.find_candidates(target_package)
+            lowest = self.strategy == LOWEST or (self.strategy == LOWEST_DIRECT and target_package.name in self.direct_names)
+            # find_candidates は record_key の昇順なので並べ直さなくてよい
+            candidates = _lowest_first(candidates) if lowest else _highest_first(candidates)
+            _vars = [var_of_record[id(record)] for record in candidates]
+            self.spec_vars[spec] = _vars
+        return _vars
+
+    def _lit_value(self, lit: int):
+        value = self.value[abs(lit)]
+        if value is None or lit > 0:
+            return value
+        return not value
+
+    def _add_clause(self, clause: list):
+        """
+        探索中に節を足す．偽でないリテラル，偽なら新しいレベルのものから順に並べて先頭 2 つを監視する
+        矛盾していればその節を，単位節なら伝播して None を返す
+        """
+        clause.sort(key=lambda lit: (self._lit_value(lit) is False, -self.level[abs(lit)]))
+        if len(clause) == 1:
+            if self._lit_value(clause[0]) is False:
+                return clause
+            if self._lit_value(clause[0]) is None:
+                self._enqueue(clause[0], clause)
+            return None
+
+        index = len(self.clauses)
+        self.clauses.append(clause)
+        self.watches.setdefault(clause[0], []).append(index)
+        self.watches.setdefault(clause[1], []).append(index)
+
+        if self._lit_value(clause[0]) is False:
+            return clause
+        if self._lit_value(clause[1]) is False and self._lit_value(clause[0]) is None:
+            self._enqueue(clause[0], clause)
+        return None
+
+    def _expand(self, var: int):
+        """
+        var が真になったときに，その依存と constrains の節を作る
+        expanded は二度と戻さないので，途中で矛盾しても節は全部足してから最初の矛盾を返す
+        """
+        self.expanded[var] = True
+        record = self.records[var]
+        self.repodata.prefetch([depend.split(' ')[0] for depend in record.depends])
+        first_conflict = None
+        requirements = []
+        for depend in record.depends:
+            depend = normalize_spec(depend)
+            if depend.split(' ')[0] in VIRTUAL_PACKAGES:
+                continue
+            candidates = self._vars_of_spec(depend)
+            requirements.append(candidates)
+            if not candidates:
+                self.uninstallable.add(var)
+            conflict = self._add_clause([-var] + candidates)
+            first_conflict = first_conflict or conflict
+        self.requirements[var] = requirements
+
+        for constrain in getattr(record, "constrains", None) or ():
+            target_package = SearchInfo.from_depend_format(normalize_spec(constrain))
+            allowed = set(self._vars_of_spec(normalize_spec(constrain)))
+            for other in self._vars_of_name(target_package.name):
+                if other not in allowed:
+                    conflict = self._add_clause([-var, -other])
+                    first_conflict = first_conflict or conflict
+        return first_conflict
+
+    # ---------- 伝播 ----------
+
+    def _enqueue(self, lit: int, reason):
+        var = abs(lit)
+        self.value[var] = lit > 0
+        self.level[var] = len(self.trail_lim)
+        self.reason[var] = reason
+        self.trail.append(lit)
+
+    def _propagate(self):
+        """
+        trail に積まれたリテラルを伝播する．矛盾したら全部偽になった節を返す
+        """
+        while self.qhead < len(self.trail):
+            lit = self.trail[self.qhead]
+            self.qhead += 1
+
+            if lit > 0:
+                # 同じ名前の他のパッケージは偽
+                for other in self.name_vars[self.var_names[lit]]:
+                    if other == lit:
+                        continue
+                    if self.value[other] is True:
+                        return [-lit, -other]
+                    if self.value[other] is None:
+                        self._enqueue(-other, [-other, -lit])
+                if not self.expanded[lit]:
+                    conflict = self._expand(lit)
+                    if conflict:
+                        return conflict
+                elif lit in self.uninstallable:
+                    return [-lit]
+
+            false_lit = -lit
+            watchers = self.watches.get(false_lit, [])
+            kept = []
+            conflict = None
+            for n, index in enumerate(watchers):
+                clause = self.clauses[index]
+                if clause[0] == false_lit:
+                    clause[0], clause[1] = clause[1], clause[0]
+                if self._lit_value(clause[0]) is True:
+                    kept.append(index)
+                    continue
+                for k in range(2, len(clause)):
+                    if self._lit_value(clause[k]) is not False:
+                        clause[1], clause[k] = clause[k], clause[1]
+                        self.watches.setdefault(clause[1], []).append(index)
+                        break
+                else:
+                    kept.append(index)
+                    if self._lit_value(clause[0]) is False:
+                        kept.extend(watchers[n + 1:])
+                        conflict = clause
+                        break
+                    self._enqueue(clause[0], clause)
+            self.watches[false_lit] = kept
+            if conflict:
+                return conflict
+
+        return None
+
+    # ---------- 学習とバックジャンプ ----------
+
+    def _analyze(self, conflict: list):
+        """
+        1UIP で学習節と戻るレベルを求める
+        """
+        current_level = len(self.trail_lim)
+        learnt = [None]
+        seen = set()
+        path = 0
+        index = len(self.trail) - 1
+        clause = conflict
+        while True:
+            for lit in clause:
+                var = abs(lit)
+                if var in seen or self.level[var] == 0:
+                    continue
+                seen.add(var)
+                if self.level[var] == current_level:
+                    path += 1
+                else:
+                    learnt.append(lit)
+            # 今のレベルで最後に割り当てた，節に出てきた変数まで戻る
+            while abs(self.trail[index]) not in seen:
+                index -= 1
+            lit = self.trail[index]
+            index -= 1
+            path -= 1
+            if path == 0:
+                learnt[0] = -lit
+                break
+            clause = self.reason[abs(lit)]
+
+        if len(learnt) == 1:
+            return learnt, 0
+        # 2 番目に監視するリテラルは一番新しいレベルのもの
+        n = max(range(1, len(learnt)), key=lambda i: self.level[abs(learnt[i])])
+        learnt[1], learnt[n] = learnt[n], learnt[1]
+        return learnt, self.level[abs(learnt[1])]
+
+    def _backtrack(self, level: int):
+        if len(self.trail_lim) <= level:
+            return
+        for lit in self.trail[self.trail_lim[level]:]:
+            var = abs(lit)
+            self.value[var] = None
+            self.reason[var] = None
+        del self.trail[self.trail_lim[level]:]
+        del self.trail_lim[level:]
+        self.qhead = len(self.trail)
+
+    # ---------- 決定 ----------
+
+    def _decide(self):
+        """
+        真になっているパッケージの依存 (と指定した spec) のうち，まだ満たされていないものを前から順に見て
+        一番優先度の高い未割り当ての候補を選ぶ．全部満たされていれば None
+        """
+        for candidates in self._open_requirements():
+            if any(self.value[v] is True for v in candidates):
+                continue
+            for v in candidates:
+                if self.value[v] is None:
+                    return v
+        return None
+
+    def _open_requirements(self):
+        yield from self.root_requirements
+        for lit in self.trail:
+            if lit > 0 and self.requirements[lit]:
+                yield from self.requirements[lit]
+
+    def _unsatisfiable(self, specs):
+        return UnsatisfiableError(f"no solution for {', '.join(specs)}")
+
+    def solve(self, specs: list) -> list:
+        """
+        specs（依存文字列のリスト）を全部満たすパッケージの組を返す．解がなければ UnsatisfiableError
+        """
+        specs = [normalize_spec(spec) for spec in specs]
+        self.direct_names = {SearchInfo.from_depend_format(spec).name for spec in specs}
+        self.root_requirements = [self._vars_of_spec(spec) for spec in specs]
+        for spec, candidates in zip(specs, self.root_requirements):
+            if not candidates:
+                raise UnsatisfiableError(f"no package are found: {spec}")
+            if self._add_clause(list(candidates)):
+                raise self._unsatisfiable(specs)
+
+        n_conflicts = 0
+        while True:
+            conflict = self._propagate()
+            if conflict:
+                n_conflicts += 1
+                if not self.trail_lim:
+                    raise self._unsatisfiable(specs)
+                learnt, backjump_level = self._analyze(conflict)
+                self._backtrack(backjump_level)
+                if self._add_clause(learnt):
+                    raise self._unsatisfiable(specs)
+                continue
+
+            var = self._decide()
+            if var is None:
+                break
+            self.trail_lim.append(len(self.trail))
+            self._enqueue(var, None)
+
+        self.n_conflicts = n_conflicts
+        return [self.records[lit] for lit in self.trail if lit > 0]
+
+
+def solve(repodata: RepoData, specs: list, strategy=HIGHEST) -> list:
+    return Solver(repodata, strategy).solve(specs)
+
+# 解は spec の順番に依らない (cached_resolve が順番を key に入れずに済む)
+solve.order_independent = True
+
+
+if __name__ == "__main__":
+    # usage: ./solver.py [--strategy highest|lowest|lowest-direct] spec [spec ...]
+    args = sys.argv[1:]
+    strategy = HIGHEST
+    if args[:1] == ["--strategy"]:
+        strategy = args[1]
+        args = args[2:]
+
+    start_time = time.time()
+    repodata = RepoData()
+    solver = Solver(repodata, strategy)
+    try:
+        result = solver.solve(args or ["numpy"])
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+
+    pprint(result)
+    print(f"{len(result)} packages, {solver.n_conflicts} conflicts, {time.time() - start_time:.2f} s")
@@ -1,6 +1,5 @@
-import sys
 import re
-from functools import total_ordering
+from functools import total_ordering, lru_cache
 from packaging.version import Version
 
 @total_ordering
@@ -20,6 +19,7 @@ class LooseVersion:
             self.fixed_prefix = ()
             self.suffix = None
             self.suffix_num = -1
+            self.key = (float('inf'),)
             return
         elif self.original.lower() == "-inf":
             self.is_inf = -1
@@ -27,11 +27,11 @@ class LooseVersion:
             self.fixed_prefix = ()
             self.suffix = None
             self.suffix_num = -1
+            self.key = (float('-inf'),)
             return
 
         # ワイルドカード対応
         if "*" in self.original:
-            print("include wildcard")
             parts = self.original.split(".")
             fixed = []
             for p in parts:
@@ -42,6 +42,7 @@ class LooseVersion:
             self.num = None
             self.suffix = None
             self.suffix_num = -1
+            self.key = (float('inf'),)
             return
 
         # 通常バージョン
@@ -53,21 +54,20 @@ class LooseVersion:
         self.suffix = m.group("suffix") if m.group("suffix") else None
         self.suffix_num = int(m.group("suffix_num")) if m.group("suffix_num") else -1
         self.fixed_prefix = self.num
+        self.key = self.num
 
     def _cmp_key(self):
-        # 無限大
-        if self.is_inf != 0:
-            return (self.is_inf,)
-        # ワイルドカードは数字部分を inf にして自然な比較
-        if self.num is None:
-            return (float('inf'),)
-        # 通常数字部分
-        return self.num
+        # 無限大は (±inf,)，ワイルドカードは数字部分を inf にして自然な比較，通常は数字部分
+        return self.key
 
     def __lt__(self, other):
+        # 通常数字部分 (一番多いので先に判定)
+        if self.num is not None and other.num is not None:
+            return self.num < other.num
+
         # 無限大
         if self.is_inf != 0 or other.is_inf != 0:
-            return self._cmp_key() < other._cmp_key()
+            return self.key < other.key
 
         # ワイルドカード同士
         if self.num is None and other.num is None:
@@ -83,18 +83,17 @@ class LooseVersion:
             # 右が * → 右は inf 扱い
             return True
 
-        # 通常数字部分
-        return self.num < other.num
+        return False
 
     def __eq__(self, other):
-        # 無限大
-        if self.is_inf != 0 or other.is_inf != 0:
-            return self.is_inf == other.is_inf
-
         # 両方数字
         if self.num is not None and other.num is not None:
             return self.num == other.num
 
+        # 無限大
+        if self.is_inf != 0 or other.is_inf != 0:
+            return self.is_inf == other.is_inf
+
         # 片方がワイルドカード
         if self.num is None and other.num is not None:
             return other.num[:len(self.fixed_prefix)] == self.fixed_prefix
@@ -109,75 +108,243 @@ class LooseVersion:
         return f"LooseVersion('{self.original}')"
 
 
-def connect_version(version1, version2):
-    def _parse(version):
-        _v = {"min": None, "max": None}
-        for cond in version:
-            match = re.match(r"(<=|>=|=|==|!=|<|>)(.+)", cond.strip())
-            if not match: # only number like 15.2.0 not >=13.0.1
-                return None
-            op, target = match.groups()
-            if op == "=" or op == "==":
-                print("connect_version failure")
-                sys.exit()
-                return
-            
-            if ">" in op:
-                _v["min"] = target
-            if "<" in op:
-                _v["max"] = target
-
-        if _v["min"] == None:
-            _v["min"] = "-inf"
-        if _v["max"] == None:
-            _v["max"] = "inf"
-        
-        return _v
-
-    a = _parse(version1)
-    b = _parse(version2)
-
-    print("a: ", a, "b: ", b)
-
-    # case1: version1 is plain version
-    if a is None:
-        v = version1[0]  # example: "15.2.0"
-        # check if v is in version2 range (b)
-        # b could also be None → both plain numbers → just return v if equal
-        if b is None:
-            LooseVersion(v)
-            
-            return v
-
-        min_ok = True
-        max_ok = True
-        if b["min"] != "-inf":
-            min_ok = LooseVersion(v) >= LooseVersion(b["min"])
-        if b["max"] != "inf":
-            max_ok = LooseVersion(v) <= LooseVersion(b["max"])
-        if min_ok and max_ok:
-            return [v]
-        else:
-            return None
-
-    # case2: version1 is range, version2 is plain version
-    if b is None:
-        return connect_version(version2, version1)
-
-    print("a: ", a, "b: ", b)
-    if not (a['min'] < b['max'] and b['min'] < a['max']):
-        return None
-    
-    upper = min([a['max'], b['max']], key=LooseVersion)
-    lower = max([a['min'], b['min']], key=LooseVersion)
+# 同じバージョン文字列は何千回も比較されるので，パース結果を LRU で使い回す
+VERSION_CACHE_SIZE = 65536
+
+@lru_cache(maxsize=VERSION_CACHE_SIZE)
+def parse_version(version: str) -> LooseVersion:
+    """
+    version 文字列ごとに一度だけ LooseVersion を作る（同じ文字列なら同じオブジェクト）
+    """
+    return LooseVersion(version)
+
+
+def version_key(version: str) -> tuple:
+    """
+    max / sorted の key 用．tuple 同士の比較が LooseVersion の大小と一致する
+    >>> max(["1.2.2", "2.2.9"], key=version_key)
+    '2.2.9'
+    """
+    return parse_version(version).key
+
+
+NEG_INF = (float('-inf'),)
+POS_INF = (float('inf'),)
+RANGE_OPERATOR_PATTERN = re.compile(r"^(>=|<=|==|!=|=|<|>)?(.+)$")
+
+
+class VersionRange:
+    """
+    バージョンの key (LooseVersion.key) の区間の集合．immutable
+    intervals は (lower, lower_inclusive, upper, upper_inclusive) の tuple を昇順に並べた，重ならない区間
+    ">=3.10,<3.11.0a0" -> [(3, 10), (3, 11, 0))      "3.13.*" -> [(3, 13), (3, 14))
+    "!=1.2"            -> [-inf, (1, 2)) | ((1, 2), inf]
+    """
+    __slots__ = ("intervals",)
+
+    def __init__(self, intervals=()):
+        self.intervals = tuple(intervals)
+
+    # ---------- 作る ----------
+
+    @staticmethod
+    def any() -> "VersionRange":
+        return VersionRange(((NEG_INF, True, POS_INF, True),))
+
+    @staticmethod
+    def none() -> "VersionRange":
+        return VersionRange()
+
+    @staticmethod
+    def point(key: tuple) -> "VersionRange":
+        return VersionRange(((key, True, key, True),))
+
+    @staticmethod
+    def prefix(fixed_prefix: tuple) -> "VersionRange":
+        # "3.13.*" は (3, 13) 以上 (3, 14) 未満
+        if not fixed_prefix:
+            return VersionRange.any()
+        upper = fixed_prefix[:-1] + (fixed_prefix[-1] + 1,)
+        return VersionRange(((fixed_prefix, True, upper, False),))
+
+    @staticmethod
+    def from_condition(condition: str) -> "VersionRange":
+        """
+        ">=3.10" / "<3.11.0a0" / "!=1.2" / "==1.2" / "=1.2" / "1.2.*" / "1.2" のどれか 1 つ
+        "=1.2" は conda と同じく "1.2.*" として扱う
+        """
+        match = RANGE_OPERATOR_PATTERN.match(condition.strip())
+        if not match:
+            raise ValueError(f"Invalid condition: {condition}")
+        operator, version = match.groups()
+        is_prefix = version.endswith(".*") or version == "*"
+        version = parse_version(version[:-2] if version.endswith(".*") else version)
+        key = version.key
+
+        if operator in (None, "==", "=", "!="):
+            if is_prefix or operator == "=":
+                _range = VersionRange.prefix(version.fixed_prefix)
+            else:
+                _range = VersionRange.point(key)
+            return _range.complement() if operator == "!=" else _range
+        # 不等号に付いた ".*" は付いていないものとして扱う (">=3.*" -> ">=3")
+        if operator == ">=":
+            return VersionRange(((key, True, POS_INF, True),))
+        if operator == ">":
+            return VersionRange(((key, False, POS_INF, True),))
+        if operator == "<=":
+            return VersionRange(((NEG_INF, True, key, True),))
+        return VersionRange(((NEG_INF, True, key, False),))
+
+    @staticmethod
+    def from_spec(spec: str) -> "VersionRange":
+        """
+        "," は AND，"|" は OR．例: ">=3.10,<3.11.0a0|3.12.*"
+        """
+        _range = VersionRange.none()
+        for alternative in spec.split("|"):
+            _alternative = VersionRange.any()
+            for condition in alternative.split(","):
+                _alternative = _alternative & VersionRange.from_condition(condition)
+            _range = _range | _alternative
+        return _range
+
+    # ---------- 集合演算 ----------
+
+    def __and__(self, other: "VersionRange") -> "VersionRange":
+        """
+        共通部分．両方とも並んでいるので前から一度なめるだけ
+        """
+        a, b = self.intervals, other.intervals
+        intervals = []
+        i = j = 0
+        while i < len(a) and j < len(b):
+            lower, lower_inclusive = _max_lower(a[i], b[j])
+            upper, upper_inclusive = _min_upper(a[i], b[j])
+            if lower < upper or (lower == upper and lower_inclusive and upper_inclusive):
+                intervals.append((lower, lower_inclusive, upper, upper_inclusive))
+            # 上端が先に来るほうを進める
+            if _upper_before(a[i], b[j]):
+                i += 1
+            else:
+                j += 1
+        return VersionRange(intervals)
+
+    def __or__(self, other: "VersionRange") -> "VersionRange":
+        """
+        和集合．下端の順に並べて，重なるか接している区間をつなぐ
+        """
+        merged = []
+        for interval in sorted(self.intervals + other.intervals, key=_lower_order):
+            if merged:
+                lower, lower_inclusive, upper, upper_inclusive = merged[-1]
+                if interval[0] < upper or (interval[0] == upper and (interval[1] or upper_inclusive)):
+                    if not _upper_before(interval, merged[-1]):
+                        merged[-1] = (lower, lower_inclusive, interval[2], interval[3])
+                    continue
+            merged.append(interval)
+        return VersionRange(merged)
+
+    def complement(self) -> "VersionRange":
+        intervals = []
+        lower, lower_inclusive = NEG_INF, True
+        for _lower, _lower_inclusive, _upper, _upper_inclusive in self.intervals:
+            if lower < _lower or (lower == _lower and lower_inclusive and not _lower_inclusive):
+                intervals.append((lower, lower_inclusive, _lower, not _lower_inclusive))
+            lower, lower_inclusive = _upper, not _upper_inclusive
+        if lower < POS_INF or (lower == POS_INF and lower_inclusive):
+            intervals.append((lower, lower_inclusive, POS_INF, True))
+        return VersionRange(intervals)
+
+    # ---------- 判定 ----------
+
+    def __contains__(self, version) -> bool:
+        """
+        version はバージョン文字列か key
+        """
+        key = version if isinstance(version, tuple) else version_key(version)
+        for lower, lower_inclusive, upper, upper_inclusive in self.intervals:
+            if key < lower or (key == lower and not lower_inclusive):
+                return False
+            if key < upper or (key == upper and upper_inclusive):
+                return True
+        return False
+
+    def is_empty(self) -> bool:
+        return not self.intervals
+
+    def __bool__(self):
+        return bool(self.intervals)
 
-    version_str = []
-    if upper and upper != 'inf':
-        version_str.append(f'<={upper}')
-    if lower and lower != '-inf':
-        version_str.append(f'>={lower}')
+    def __eq__(self, other):
+        return isinstance(other, VersionRange) and self.intervals == other.intervals
+
+    def __hash__(self):
+        return hash(self.intervals)
+
+    def __str__(self):
+        def _version(key):
+            return ".".join(map(str, key))
+
+        alternatives = []
+        for lower, lower_inclusive, upper, upper_inclusive in self.intervals:
+            if lower == upper:
+                alternatives.append(f"=={_version(lower)}")
+                continue
+            conditions = []
+            if lower != NEG_INF:
+                conditions.append(f"{'>=' if lower_inclusive else '>'}{_version(lower)}")
+            if upper != POS_INF:
+                conditions.append(f"{'<=' if upper_inclusive else '<'}{_version(upper)}")
+            alternatives.append(",".join(conditions) or "*")
+        return "|".join(alternatives)
 
-    return version_str
+    def __repr__(self):
+        return f"VersionRange('{self}')"
+
+
+def _lower_order(interval):
+    # 同じ値なら含むほうが先
+    return (interval[0], not interval[1])
+
+
+def _max_lower(a, b):
+    if a[0] != b[0]:
+        return (a[0], a[1]) if a[0] > b[0] else (b[0], b[1])
+    return a[0], a[1] and b[1]
+
+
+def _min_upper(a, b):
+    if a[2] != b[2]:
+        return (a[2], a[3]) if a[2] < b[2] else (b[2], b[3])
+    return a[2], a[3] and b[3]
+
+
+def _upper_before(a, b) -> bool:
+    # a の上端が b の上端以下か
+    return a[2] < b[2] or (a[2] == b[2] and (not a[3] or b[3]))
+
+
+def _as_range(version) -> VersionRange:
+    # None (条件なし) / VersionRange / spec 文字列 / 条件のリスト
+    if version is None:
+        return VersionRange.any()
+    if isinstance(version, VersionRange):
+        return version
+    if isinstance(version, str):
+        return VersionRange.from_spec(version)
+    return VersionRange.from_spec(",".join(version))
+
+
+def connect_version(version1, version2):
+    """
+    2 つのバージョン条件 (条件のリスト ['>=3.10', '<3.11'] / spec 文字列 / VersionRange / None) の共通部分を返す
+    共通部分が無ければ None．パースできない条件は ValueError
+    >>> connect_version(['>3.14', '<3.20'], ['>3.10', '<3.16'])
+    VersionRange('>3.14,<3.16')
+    """
+    _range = _as_range(version1) & _as_range(version2)
+    return _range if _range else None
 
 
 # ----------- 使い方 -----------